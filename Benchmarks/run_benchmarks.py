@@ -0,0 +1,196 @@
+"""
+    Benchmark suite for the preprocessing and data loading hot paths.
+
+    Generates a seeded synthetic corpus (see synthetic_corpus.py), runs
+    each stage and reports lines/s, MB/s and peak traced memory. Results
+    are saved as JSON together with the current commit, and can be
+    compared against an earlier results file with --compare.
+"""
+
+import argparse, json, platform, re, subprocess, sys, tempfile, time
+import tracemalloc
+
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Optional
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path[:0] = [str(ROOT / "Preprocessing"), str(ROOT / "Model")]
+
+from synthetic_corpus import SyntheticCorpus
+from generate_romanization import Romanizer
+from preprocess_wikidump import SEP, preprocess_file
+from vocab import Vocabulary
+
+
+def legacy_wikidump(text: str, seps: str = ".") -> str:
+    """
+    The original four regex passes of preprocess_wikidump.py, kept as
+    a reference point
+
+    """
+    re_tags = re.compile(r"<[^<>]*>")
+    re_newline = re.compile(r"\n+")
+    re_esc_seps = re.compile("([" + re.escape(seps) + r"]+\s*)")
+    re_sep_marker = re.compile(SEP)
+
+    text = re_tags.sub("", text)
+    text = re_esc_seps.sub(r"\1" + SEP, text)
+    text = re_sep_marker.sub(r"\n", text)
+    text = re_newline.sub("\n", text)
+    return(text.lstrip())
+
+
+def measure(func: Callable, repeat: int = 3, memory: bool = True,
+            setup: Optional[Callable] = None) -> dict:
+    """
+    Returns the best wall time of repeat calls of func and, if memory is
+    True, the peak memory traced by tracemalloc during one extra call.
+    setup is called untimed before every call.
+
+    """
+    setup = setup if setup is not None else (lambda: None)
+    times = []
+    for _ in range(repeat):
+        setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    result = {"seconds": min(times)}
+    if memory:
+        setup()
+        tracemalloc.start()
+        func()
+        result["peak_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    return(result)
+
+
+def build_stages(key: str, work_dir: str, num_lines: int,
+                 seed: int) -> dict[str, tuple]:
+    """
+    Builds the benchmarked stages. Each entry maps a stage name to
+    (function, number of lines, number of bytes processed), optionally
+    followed by a setup function that measure calls before every run.
+
+    """
+    corpus = SyntheticCorpus(key, seed)
+    plain = corpus.write(f"{work_dir}/plain", num_lines)[0]
+    dump = corpus.write(f"{work_dir}/dump", num_lines, wikidump=True)[0]
+
+    lines = open(plain, encoding='utf8').readlines()
+    text = open(plain, encoding='utf8').read()
+    dump_text = open(dump, encoding='utf8').read()
+    size = len(text.encode('utf8'))
+    dump_size = len(dump_text.encode('utf8'))
+
+    romanizer = Romanizer.from_file(key)
+    # segment_str is timed from an empty cache, on its own Romanizer
+    segmenter = Romanizer.from_file(key)
+    vocab = Vocabulary.from_files([plain])
+    char_lists = [list(''.join(line.split())) for line in lines]
+
+    stages = {
+        "segment_str": (lambda: [segmenter.segment_str(line)
+                                 for line in lines],
+                        len(lines), size, segmenter.clear_segment_cache),
+        "get_trans_str": (lambda: [romanizer.get_trans_str(line)
+                                   for line in lines], len(lines), size),
+        "romanize_batch": (lambda: romanizer.romanize_batch(lines, seed),
+                           len(lines), size),
+        "romanize_file": (lambda: romanizer.romanize_file(
+            plain, f"{work_dir}/romanized", seed=seed), len(lines), size),
+        "wikidump_regex": (lambda: legacy_wikidump(dump_text, ".։"),
+                           len(lines), dump_size),
+        "wikidump_stream": (lambda: preprocess_file(
+            dump, f"{work_dir}/preprocessed", ".։"), len(lines), dump_size),
+        "vocab_from_files": (lambda: Vocabulary.from_files([plain]),
+                             len(lines), size),
+        "tokens_to_indices": (lambda: [vocab.tokens_to_indices(c)
+                                       for c in char_lists],
+                              len(lines), size),
+        "encode_batch": (lambda: vocab.encode_batch(lines), len(lines), size),
+    }
+
+    try:
+        from data import RomanizationDataLoader
+    except ImportError:
+        return(stages)
+
+    samples = list(zip(vocab.encode_batch(lines), vocab.encode_batch(lines)))
+    batches = [samples[i:i + 256] for i in range(0, len(samples), 256)]
+    stages["pad_batches"] = (
+        lambda: [RomanizationDataLoader.pad_batches(b) for b in batches],
+        len(lines), size)
+
+    return(stages)
+
+
+def git_commit() -> str:
+    try:
+        return(subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT,
+                              capture_output=True, text=True,
+                              check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return("unknown")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--key", type=str,
+                        default=str(ROOT / "RomanizationKeys" /
+                                    "hye_translit_key.txt"),
+                        help="Romanization key used for the corpus and\
+                            the romanizer")
+    parser.add_argument("--lines", type=int, default=50000,
+                        help="number of sentences in the synthetic corpus")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="number of timed runs per stage (best is kept)")
+    parser.add_argument("--stages", type=str, nargs="+", default=None,
+                        help="only run these stages")
+    parser.add_argument("--no_memory", action="store_true",
+                        help="skip the extra tracemalloc run per stage")
+    parser.add_argument("--out", type=str, default="bench_results.json",
+                        help="JSON file for the results")
+    parser.add_argument("--compare", type=str, default=None,
+                        help="earlier results file to compare against")
+
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        stages = build_stages(args.key, work_dir, args.lines, args.seed)
+        for name, (func, num_lines, num_bytes, *setup) in stages.items():
+            if args.stages is not None and name not in args.stages:
+                continue
+            result = measure(func, args.repeat, not args.no_memory,
+                             *setup)
+            result["lines_per_s"] = num_lines / result["seconds"]
+            result["mb_per_s"] = num_bytes / 2**20 / result["seconds"]
+            results[name] = result
+
+            memory = f"{result['peak_mb']:9.1f} MB peak" \
+                if "peak_mb" in result else ""
+            print(f"{name:20s} {result['lines_per_s']:12.0f} lines/s "
+                  f"{result['mb_per_s']:8.2f} MB/s {memory}")
+
+    report = {"commit": git_commit(),
+              "time": datetime.now(timezone.utc).isoformat(),
+              "python": platform.python_version(),
+              "config": {"lines": args.lines, "seed": args.seed,
+                         "repeat": args.repeat, "key": args.key},
+              "results": results}
+
+    with open(args.out, "w", encoding="utf8") as f:
+        json.dump(report, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare, encoding="utf8") as f:
+            old = json.load(f)
+        print(f"\nspeedup vs {old['commit'][:10]}:")
+        for name, result in results.items():
+            if name in old["results"]:
+                ratio = old["results"][name]["seconds"] / result["seconds"]
+                print(f"{name:20s} {ratio:6.2f}x")
@@ -0,0 +1,156 @@
+"""
+    Seeded generator for synthetic corpora in original orthography,
+    built from the characters of a Romanization key.
+
+    Letters get Zipf-distributed frequencies and are combined into a
+    Zipf-distributed word list, so words repeat as in natural text.
+    Sentences are capitalized, may contain commas and numbers, and end in
+    one of the key's sentence-final punctuation marks. Output can be
+    plain (one sentence per line) or in the wikiextractor format read by
+    preprocess_wikidump.py.
+"""
+
+import argparse, sys
+import numpy as np
+
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path[:0] = [str(ROOT / "Preprocessing"), str(ROOT / "Model")]
+
+from generate_romanization import Romanizer
+
+
+def key_chars(key_file: str, encoding: str = 'utf8') -> tuple[list, list]:
+    """
+    Returns the letters (including multi-char letters) and the
+    punctuation marks listed in a Romanization key
+
+    """
+    letters, punctuation = [], []
+    for char in Romanizer.from_file(key_file, encoding=encoding).char_probs:
+        # keys are lowercase; Romanizer adds the capitalized versions
+        if char == char.lower():
+            (letters if char.isalpha() else punctuation).append(char)
+    return(letters, punctuation)
+
+
+class SyntheticCorpus:
+    
+    def __init__(self, key_file: str, seed: int = 0, vocab_size: int = 20000,
+                 encoding: str = 'utf8'):
+        """
+        Generator of synthetic sentences.
+
+        Parameters
+        ----------
+        key_file : str
+            Romanization key whose characters are used
+        seed : int, optional
+            random seed; the same seed gives the same corpus
+        vocab_size : int, optional
+            number of distinct words. default is 20000
+
+        """
+        self.rng = np.random.default_rng(seed)
+        letters, punctuation = key_chars(key_file, encoding)
+        
+        # Zipf-like letter frequencies in a random order
+        letter_probs = 1 / np.arange(1, len(letters) + 1)
+        self.rng.shuffle(letter_probs)
+        letter_probs /= letter_probs.sum()
+        
+        lengths = np.clip(self.rng.poisson(5, vocab_size), 1, 15)
+        picks = self.rng.choice(len(letters), size=lengths.sum(),
+                                p=letter_probs)
+        words = []
+        start = 0
+        for length in lengths:
+            words.append(''.join(letters[i] for i in
+                                 picks[start:start + length]))
+            start += length
+        self.words = np.array(words, dtype=object)
+        
+        self.word_probs = 1 / np.arange(1, vocab_size + 1) ** 1.1
+        self.word_probs /= self.word_probs.sum()
+        
+        # sentence-final marks: the key's full stops, else a period
+        self.finals = [p for p in punctuation if p in "։․."] or ["."]
+        
+    def sentences(self, n: int) -> list[str]:
+        """
+        Returns n sentences
+
+        """
+        lengths = np.clip(self.rng.poisson(11, n), 2, 60)
+        words = self.rng.choice(self.words, size=lengths.sum(),
+                                p=self.word_probs)
+        commas = self.rng.random(lengths.sum()) < 0.06
+        numbers = self.rng.random(lengths.sum()) < 0.02
+        finals = self.rng.choice(self.finals, size=n)
+        
+        sentences = []
+        start = 0
+        for i, length in enumerate(lengths):
+            tokens = []
+            for j in range(start, start + length):
+                word = str(self.rng.integers(1, 2100)) if numbers[j] \
+                    else words[j]
+                tokens.append(word + ',' if commas[j] else word)
+            start += length
+            sentence = ' '.join(tokens).rstrip(',')
+            sentences.append(sentence[0].upper() + sentence[1:] + finals[i])
+        return(sentences)
+    
+    def write(self, out_dir: str, num_lines: int, num_files: int = 1,
+              wikidump: bool = False, lines_per_doc: int = 50,
+              encoding: str = 'utf8') -> list[str]:
+        """
+        Writes num_lines sentences spread over num_files files in out_dir.
+        With wikidump=True, sentences are grouped into <doc> elements
+        with several sentences per line, as in wikiextractor output.
+        Returns the file names.
+
+        """
+        Path(out_dir).mkdir(parents=True, exist_ok=True)
+        files = []
+        per_file = -(-num_lines // num_files)
+        
+        for k in range(num_files):
+            sentences = self.sentences(min(per_file,
+                                           num_lines - k * per_file))
+            name = f"{out_dir}/wiki_{k:02d}"
+            with open(name, 'w', encoding=encoding) as f:
+                if wikidump:
+                    for d in range(0, len(sentences), lines_per_doc):
+                        doc = sentences[d:d + lines_per_doc]
+                        f.write(f'<doc id="{k}_{d}" url="?curid={k}_{d}" '
+                                f'title="{doc[0].split()[0]}">\n')
+                        # a few sentences per paragraph
+                        for p in range(0, len(doc), 4):
+                            f.write(' '.join(doc[p:p + 4]) + '\n\n')
+                        f.write('</doc>\n')
+                else:
+                    f.write('\n'.join(sentences) + '\n')
+            files.append(name)
+        return(files)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--key", type=str,
+                        help="name of .txt file containing Romanization key")
+    parser.add_argument("--out_dir", type=str, default="synthetic",
+                        help="name of output directory")
+    parser.add_argument("--lines", type=int, default=100000,
+                        help="number of sentences")
+    parser.add_argument("--files", type=int, default=1,
+                        help="number of files")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("--wikidump", action="store_true",
+                        help="write in wikiextractor format")
+    
+    args = parser.parse_args()
+    
+    SyntheticCorpus(args.key, args.seed).write(
+        args.out_dir, args.lines, args.files, args.wikidump)
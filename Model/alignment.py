@@ -0,0 +1,90 @@
+"""
+    Module for segment alignments between text in original orthography
+    and its romanization, as produced by Romanizer.get_trans_str,
+    romanize_batch and romanize_file (see generate_romanization.py).
+
+    An alignment is an int64 array with one row per segment boundary;
+    row k holds the offsets of the k-th boundary in the original and in
+    the romanized string, so the first row is (0, 0) and the last one
+    holds both lengths. Alignment files have one line per text line,
+    listing the rows after the first as "original:romanized" pairs.
+"""
+
+import numpy as np
+
+from functools import cache
+
+from vocab import whitespace_chars
+
+# type aliases
+Alignment = np.ndarray
+
+
+def format_alignment(alignment: Alignment) -> str:
+    return(' '.join(f"{i}:{j}" for i, j in alignment[1:].tolist()) + '\n')
+
+
+def parse_alignment(line: str) -> Alignment:
+    values = np.array(line.replace(':', ' ').split(), dtype=np.int64)
+    return(np.concatenate([[0, 0], values]).reshape(-1, 2))
+
+
+def token_counts(string: str, offsets: np.ndarray) -> np.ndarray:
+    """
+    Returns the number of non-whitespace characters (the tokens kept by
+    Vocabulary.encode) before each offset of string
+
+    """
+    codepoints = np.frombuffer(string.encode('utf-32-le', 'surrogatepass'),
+                               dtype=np.uint32)
+    counts = np.zeros(len(codepoints) + 1, dtype=np.int64)
+    np.cumsum(~np.isin(codepoints, _whitespace_codepoints()), out=counts[1:])
+    return(counts[np.minimum(offsets, len(codepoints))])
+
+
+def aligned_windows(source: str, target: str, alignment: Alignment,
+                    max_len: int) -> list[tuple[str, str]]:
+    """
+    Cuts a (romanized source, original target) pair into windows with
+    at most max_len tokens on either side, only at segment boundaries of
+    the alignment, so every window of the source is the romanization of
+    the matching window of the target. Windows end after whitespace in
+    the target where possible. A single segment longer than max_len
+    becomes a window of its own. Windows without tokens are dropped.
+
+    """
+    src_tokens = token_counts(source, alignment[:, 1])
+    tgt_tokens = token_counts(target, alignment[:, 0])
+    if src_tokens[-1] <= max_len and tgt_tokens[-1] <= max_len:
+        return([(source, target)])
+
+    # boundaries that follow whitespace in the target
+    breaks = np.zeros(len(alignment), dtype=bool)
+    breaks[1:] = np.diff(tgt_tokens) == 0
+
+    windows = []
+    start, last = 0, len(alignment) - 1
+    while start < last:
+        end = min(np.searchsorted(src_tokens, src_tokens[start] + max_len,
+                                  side='right'),
+                  np.searchsorted(tgt_tokens, tgt_tokens[start] + max_len,
+                                  side='right')) - 1
+        if end <= start:
+            end = start + 1
+        elif end < last:
+            preferred = np.flatnonzero(breaks[start + 1:end + 1])
+            if len(preferred) > 0:
+                end = start + 1 + preferred[-1]
+
+        if src_tokens[end] > src_tokens[start] \
+            or tgt_tokens[end] > tgt_tokens[start]:
+            (i, j), (k, l) = alignment[start], alignment[end]
+            windows.append((source[j:l], target[i:k]))
+        start = end
+    return(windows)
+
+
+@cache
+def _whitespace_codepoints() -> np.ndarray:
+    # codepoints that are removed when lines are encoded
+    return(np.array(sorted(map(ord, whitespace_chars())), dtype=np.uint32))
@@ -0,0 +1,454 @@
+"""
+    Rule-based deromanization baseline.
+
+    Romanized text is decoded with a noisy channel model: an inverted
+    Romanization key gives the probability of each Latin string given an
+    original character, and a character n-gram model estimated from a
+    corpus in the original orthography scores the output. Lines are
+    decoded with a batched beam search over the segmentation lattice.
+
+    The Romanization key is parsed with generate_romanization.Romanizer,
+    so /Preprocessing/ needs to be on the PYTHONPATH.
+"""
+
+import argparse, glob, json
+import numpy as np
+
+from itertools import chain, islice
+from pathlib import Path
+from typing import Iterable, Optional
+
+from vocab import BOS, Vocabulary
+from fileio import open_text
+
+# constants
+SPACE = " "
+# number of lines counted at a time
+CHUNK_LINES = 2**14
+# number of counted chunks merged at once
+MERGE_CHUNKS = 16
+
+
+def _merge_counts(keys: list[np.ndarray],
+                  counts: list[np.ndarray]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Merges (sorted unique keys, counts) arrays into one pair
+
+    """
+    unique, inverse = np.unique(np.concatenate(keys), return_inverse=True)
+    merged = np.bincount(inverse, weights=np.concatenate(counts))
+    return(unique, merged.astype(np.int64))
+
+
+def encode_lines(vocab: Vocabulary, lines: Iterable[str]) -> list[np.ndarray]:
+    """
+    Maps lines to int64 arrays of character ids, with runs of whitespace
+    mapped to a single SPACE (which must be a special of vocab)
+
+    """
+    space = vocab.token_to_index[SPACE]
+    words = [line.split() for line in lines]
+    flat, offsets = vocab.encode_batch(chain.from_iterable(words),
+                                       return_offsets=True)
+    encoded = []
+    start = 0
+    for line_words in words:
+        end = start + len(line_words)
+        ids = flat[offsets[start]:offsets[end]].astype(np.int64)
+        encoded.append(np.insert(ids, offsets[start + 1:end]
+                                 - offsets[start], space))
+        start = end
+    return(encoded)
+
+
+class CharNgramModel:
+    def __init__(self, vocab: Vocabulary, order: int,
+                 keys: list[np.ndarray], counts: list[np.ndarray],
+                 alpha: float = 0.4) -> None:
+        """
+        Character n-gram model with stupid backoff.
+
+        Parameters
+        ----------
+        vocab : Vocabulary
+            characters of the model, with BOS and SPACE as specials
+        order : int
+            n-gram order
+        keys, counts : list[np.ndarray]
+            for k = 1 .. order, the sorted k-grams (encoded as base
+            len(vocab) integers) and their counts
+        alpha : float, optional
+            backoff factor. default is 0.4
+
+        """
+        self.vocab = vocab
+        self.order = order
+        self.keys = keys
+        self.counts = counts
+        self.alpha = alpha
+        self.size = len(vocab)
+        self.bos = vocab.token_to_index[BOS]
+        self.space = vocab.token_to_index[SPACE]
+        self.powers = self.size ** np.arange(order, dtype=np.int64)[::-1]
+
+        # add-one unigram distribution, so every character has a score
+        unigrams = np.zeros(self.size, dtype=np.float64)
+        unigrams[keys[0]] = counts[0]
+        self.unigram_logp = np.log((unigrams + 1)
+                                   / (unigrams.sum() + self.size))
+
+        # number of times each context was followed by any character
+        self.context_keys = [None]
+        self.context_counts = [None]
+        for k in range(2, order + 1):
+            context_keys, inverse = np.unique(keys[k - 1] // self.size,
+                                              return_inverse=True)
+            self.context_keys.append(context_keys)
+            self.context_counts.append(np.bincount(
+                inverse, weights=counts[k - 1]))
+
+    def log_probs(self, contexts: np.ndarray,
+                  chars: np.ndarray) -> np.ndarray:
+        """
+        Scores a batch of characters given their contexts.
+
+        Parameters
+        ----------
+        contexts : np.ndarray
+            int64 array of shape (n, order - 1) with the preceding
+            character ids, padded with BOS on the left
+        chars : np.ndarray
+            int64 array of n character ids
+
+        """
+        scores = np.empty(len(chars), dtype=np.float64)
+        backoff = np.zeros(len(chars), dtype=np.float64)
+        remaining = np.arange(len(chars))
+
+        for k in range(self.order, 1, -1):
+            if len(remaining) == 0:
+                return(scores)
+            context = contexts[remaining, self.order - k:]
+            context_key = context @ self.powers[-(k - 1):]
+            key = context_key * self.size + chars[remaining]
+
+            keys = self.keys[k - 1]
+            index = np.minimum(np.searchsorted(keys, key), len(keys) - 1)
+            found = keys[index] == key if len(keys) else \
+                np.zeros(len(key), dtype=bool)
+
+            hits = remaining[found]
+            context_index = np.searchsorted(self.context_keys[k - 1],
+                                            context_key[found])
+            scores[hits] = backoff[hits] + np.log(
+                self.counts[k - 1][index[found]]
+                / self.context_counts[k - 1][context_index])
+
+            remaining = remaining[~found]
+            backoff[remaining] += np.log(self.alpha)
+
+        scores[remaining] = backoff[remaining] \
+            + self.unigram_logp[chars[remaining]]
+        return(scores)
+
+    def save(self, file: str) -> None:
+        """
+        Saves the model as a single .npz file
+
+        """
+        arrays = {f"keys_{k}": self.keys[k - 1]
+                  for k in range(1, self.order + 1)}
+        arrays.update({f"counts_{k}": self.counts[k - 1]
+                       for k in range(1, self.order + 1)})
+        meta = {"order": self.order, "alpha": self.alpha,
+                "vocab": self.vocab.to_dict()}
+        np.savez_compressed(file, meta=np.array(json.dumps(meta)), **arrays)
+
+    @classmethod
+    def load(cls, file: str):
+        """
+        Loads a model written by save
+
+        """
+        with np.load(file) as data:
+            meta = json.loads(str(data["meta"]))
+            order = meta["order"]
+            keys = [data[f"keys_{k}"] for k in range(1, order + 1)]
+            counts = [data[f"counts_{k}"] for k in range(1, order + 1)]
+        return(cls(Vocabulary.from_dict(meta["vocab"]), order, keys, counts,
+                   meta["alpha"]))
+
+    @classmethod
+    def from_files(cls, files: list[str], order: int = 5,
+                   min_freq: int = 1, encoding: str = 'utf8',
+                   workers: Optional[int] = 1, alpha: float = 0.4):
+        """
+        Estimates a model from files in the original orthography, reading
+        CHUNK_LINES lines at a time. Characters seen fewer than min_freq
+        times are mapped to UNK.
+
+        """
+        vocab = Vocabulary.from_files(files, encoding, workers,
+                                      specials=[BOS, SPACE],
+                                      min_freq=min_freq)
+        if len(vocab) ** order >= 2**63:
+            raise ValueError(f"Order {order} is too high for "
+                             f"{len(vocab)} characters.")
+
+        bos = vocab.token_to_index[BOS]
+        powers = len(vocab) ** np.arange(order, dtype=np.int64)[::-1]
+        parts = [([], []) for _ in range(order)]
+
+        for file in files:
+            with open_text(file, encoding=encoding) as f:
+                for lines in iter(lambda: list(islice(f, CHUNK_LINES)), []):
+                    encoded = encode_lines(vocab, lines)
+                    padded = np.concatenate(list(chain.from_iterable(
+                        (np.full(order - 1, bos), ids) for ids in encoded)))
+                    # k-grams ending in a real character
+                    real = padded != bos
+                    for k in range(1, order + 1):
+                        windows = np.lib.stride_tricks.sliding_window_view(
+                            padded, k)[real[k - 1:]]
+                        keys, counts = np.unique(
+                            windows @ powers[-k:], return_counts=True)
+                        parts[k - 1][0].append(keys)
+                        parts[k - 1][1].append(counts)
+                        if len(parts[k - 1][0]) >= MERGE_CHUNKS:
+                            merged = _merge_counts(*parts[k - 1])
+                            parts[k - 1] = ([merged[0]], [merged[1]])
+
+        keys, counts = [], []
+        for k_keys, k_counts in parts:
+            merged = _merge_counts(k_keys or [np.zeros(0, dtype=np.int64)],
+                                   k_counts or [np.zeros(0, dtype=np.int64)])
+            keys.append(merged[0])
+            counts.append(merged[1])
+
+        return(cls(vocab, order, keys, counts, alpha))
+
+
+class InvertedKey:
+    def __init__(self, romanizer) -> None:
+        """
+        Maps Latin strings to the original characters they romanize,
+        with log P(Latin string | original character) as parsed by
+        Romanizer (including the capitalized entries). Characters that
+        can be romanized as nothing become epsilon arcs.
+
+        """
+        self.arcs = {}
+        self.epsilons = []
+        for char in romanizer.char_probs:
+            for latin, logp in romanizer.ranked_candidates(char):
+                if latin == '':
+                    self.epsilons.append((char, logp))
+                else:
+                    self.arcs.setdefault(latin, []).append((char, logp))
+        self.max_len = max(map(len, self.arcs), default=1)
+
+    def arcs_at(self, line: str, i: int,
+                identity_logp: float) -> list[tuple[int, str, float]]:
+        """
+        Returns (length, original string, log prob) for all arcs that
+        start at position i of line. Each character can also be copied
+        unchanged; that costs identity_logp if the key covers it.
+
+        """
+        arcs = []
+        for length in range(1, min(self.max_len, len(line) - i) + 1):
+            for char, logp in self.arcs.get(line[i:i + length], ()):
+                arcs.append((length, char, logp))
+        arcs.append((1, line[i], identity_logp
+                     if line[i] in self.arcs else 0.0))
+        return(arcs)
+
+    @classmethod
+    def from_file(cls, key_file: str, encoding: str = 'utf8'):
+        from generate_romanization import Romanizer
+        return(cls(Romanizer.from_file(key_file, encoding=encoding)))
+
+
+class Deromanizer:
+    def __init__(self, key: InvertedKey, lm: CharNgramModel,
+                 beam_size: int = 8, lm_weight: float = 1.0,
+                 identity_logp: float = -10.0) -> None:
+        """
+        Decodes romanized lines with a beam search over the segmentation
+        lattice of the inverted key, scoring hypotheses by
+        log P(Latin | original) + lm_weight * log P(original).
+        Hypotheses with the same position and n-gram context are
+        recombined, keeping the best one.
+
+        Parameters
+        ----------
+        key : InvertedKey
+        lm : CharNgramModel
+        beam_size : int, optional
+            hypotheses kept per input position. default is 8
+        lm_weight : float, optional
+            weight of the n-gram model score. default is 1.0
+        identity_logp : float, optional
+            log prob of copying a character that the key covers.
+            default is -10.0
+
+        """
+        self.key = key
+        self.lm = lm
+        self.beam_size = beam_size
+        self.lm_weight = lm_weight
+        self.identity_logp = identity_logp
+        self._piece_ids = {}
+
+    def _ids(self, piece: str) -> tuple[int, ...]:
+        ids = self._piece_ids.get(piece)
+        if ids is None:
+            ids = tuple(encode_lines(self.lm.vocab, [piece])[0].tolist()) \
+                if not piece.isspace() else (self.lm.space,)
+            self._piece_ids[piece] = ids
+        return(ids)
+
+    def _prune(self, beam: dict) -> dict:
+        if len(beam) <= self.beam_size:
+            return(beam)
+        best = sorted(beam.items(), key=lambda item: -item[1][0])
+        return(dict(best[:self.beam_size]))
+
+    def _extend(self, expansions: list[tuple], beams: list[list[dict]]
+                ) -> None:
+        """
+        Scores expansions (line, target position, context, score, text,
+        piece, channel log prob, epsilon flag) with one n-gram model call
+        and merges them into the beams
+
+        """
+        if not expansions:
+            return
+        width = self.lm.order - 1
+        contexts, chars, owners = [], [], []
+        for e, (_, _, context, _, _, piece, _, _) in enumerate(expansions):
+            history = list(context)
+            for char in self._ids(piece):
+                contexts.append(history[len(history) - width:])
+                chars.append(char)
+                owners.append(e)
+                history.append(char)
+
+        scores = self.lm.log_probs(
+            np.array(contexts, dtype=np.int64).reshape(-1, width),
+            np.array(chars, dtype=np.int64))
+        lm_scores = np.bincount(owners, weights=scores,
+                                minlength=len(expansions))
+
+        for (b, pos, context, score, text, piece, logp, eps), lm_score \
+            in zip(expansions, lm_scores.tolist()):
+            new_score = score + logp + self.lm_weight * lm_score
+            new_context = (context + self._ids(piece))[-width:] \
+                if width > 0 else ()
+            old = beams[b][pos].get(new_context)
+            if old is None or old[0] < new_score:
+                beams[b][pos][new_context] = (new_score, text + piece, eps)
+
+    def decode_batch(self, lines: list[str]) -> list[str]:
+        """
+        Deromanizes a batch of lines. All lines advance through the
+        lattice together, so each step makes one n-gram model call for
+        the whole batch.
+
+        """
+        lines = [line.rstrip('\n') for line in lines]
+        start = (self.lm.bos,) * (self.lm.order - 1)
+        beams = [[{} for _ in range(len(line) + 1)] for line in lines]
+        for beam in beams:
+            beam[0][start] = (0.0, "", False)
+
+        for i in range(max(map(len, lines), default=0) + 1):
+            active = [b for b in range(len(lines)) if i <= len(lines[b])]
+            for b in active:
+                beams[b][i] = self._prune(beams[b][i])
+
+            # insert characters romanized as nothing, at most one in a row
+            self._extend([(b, i, context, score, text, char, logp, True)
+                          for b in active
+                          for context, (score, text, eps)
+                          in beams[b][i].items() if not eps
+                          for char, logp in self.key.epsilons], beams)
+
+            expansions = []
+            for b in active:
+                if i == len(lines[b]):
+                    continue
+                beams[b][i] = self._prune(beams[b][i])
+                arcs = self.key.arcs_at(lines[b], i, self.identity_logp)
+                for context, (score, text, _) in beams[b][i].items():
+                    for length, piece, logp in arcs:
+                        expansions.append((b, i + length, context, score,
+                                           text, piece, logp, False))
+                # finished positions are not needed any more
+                beams[b][i] = {}
+            self._extend(expansions, beams)
+
+        return([max(beam[-1].values())[1] if beam[-1] else ""
+                for beam in beams])
+
+    def decode_file(self, in_file: str, out_file: str,
+                    batch_lines: int = 256, encoding: str = 'utf8') -> None:
+        """
+        Deromanizes a file batch_lines lines at a time
+
+        """
+        with open_text(in_file, encoding=encoding) as f_in, \
+            open_text(out_file, mode="w", encoding=encoding) as f_out:
+            for lines in iter(lambda: list(islice(f_in, batch_lines)), []):
+                f_out.writelines(line + "\n"
+                                 for line in self.decode_batch(lines))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--key", type=str,
+                        help="name of .txt file containing Romanization key")
+    parser.add_argument("--corpus", type=str, default=None,
+                        help="directory of text in the original orthography\
+                            to estimate the n-gram model from")
+    parser.add_argument("--lm", type=str, default="ngram_lm.npz",
+                        help="n-gram model file; written if --corpus is\
+                            given, read otherwise")
+    parser.add_argument("--order", type=int, default=5,
+                        help="n-gram order")
+    parser.add_argument("--min_freq", type=int, default=1,
+                        help="characters seen fewer times become UNK")
+    parser.add_argument("--in_file", type=str, default=None,
+                        help="romanized file to decode")
+    parser.add_argument("--out_file", type=str, default=None,
+                        help="output file for the decoded lines")
+    parser.add_argument("--beam_size", type=int, default=8,
+                        help="hypotheses kept per input position")
+    parser.add_argument("--lm_weight", type=float, default=1.0,
+                        help="weight of the n-gram model score")
+    parser.add_argument("--batch_lines", type=int, default=256,
+                        help="number of lines decoded together")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="processes used to count the corpus\
+                            characters; default is all cores")
+    parser.add_argument("--encoding", type=str, default='utf8',
+                        help="document encoding")
+
+    args = parser.parse_args()
+
+    if args.corpus is not None:
+        files = sorted(f for f in glob.glob(args.corpus + "/**",
+                                            recursive=True)
+                       if Path(f).is_file())
+        lm = CharNgramModel.from_files(files, args.order, args.min_freq,
+                                       args.encoding, args.workers)
+        lm.save(args.lm)
+    else:
+        lm = CharNgramModel.load(args.lm)
+
+    if args.in_file is not None:
+        deromanizer = Deromanizer(InvertedKey.from_file(args.key,
+                                                        args.encoding),
+                                  lm, args.beam_size, args.lm_weight)
+        deromanizer.decode_file(args.in_file, args.out_file,
+                                args.batch_lines, args.encoding)
@@ -1,22 +1,38 @@
 """
-    Module for dataset objects RomanizationDataset and
-    RomanizationDataLoader, which inherit from corresponding
-    torch classes
+    Module for dataset objects RomanizationDataset,
+    MemmapRomanizationDataset, StreamingRomanizationDataset,
+    OnTheFlyRomanizationDataset and RomanizationDataLoader, which
+    inherit from corresponding torch classes
 """
 
+import json, os
+import numpy as np
 import torch
 
-from torch.utils.data import DataLoader, Dataset
+from itertools import chain, islice
+from collections import Counter
+from pathlib import Path
+
+from torch.utils.data import (DataLoader, Dataset, IterableDataset, Sampler,
+                              get_worker_info)
 from torch import Tensor
-from typing import Any, Callable, Iterable
+from typing import Any, Callable, Iterable, NamedTuple, Optional
 
-from vocab import Vocabulary
+from vocab import CharFilter, Vocabulary
+from alignment import aligned_windows, parse_alignment
+from instrumentation import STATS
+from fileio import IO_BUFFER, iter_line_range, open_text
 
 # type aliases
-Datum = list[list, list]
+Datum = tuple[np.ndarray, np.ndarray]
 
 # constants
 PAD = "<PAD>"
+SIDES = ("src", "tgt")
+# number of lines encoded at a time when tokenizing files
+CHUNK_LINES = 2**16
+# lines between the indexed offsets used to cut files into shards
+INDEX_LINES = 2**12
 
 class RomanizationDataset(Dataset):
     def __init__(self, data: list[Datum], source_vocab: Vocabulary,
@@ -31,57 +47,774 @@ class RomanizationDataset(Dataset):
     
     def __len__(self) -> int:
         return(len(self.data))
+    
+    def lengths(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns arrays of source and target lengths for all examples
+
+        """
+        return(np.fromiter((len(d[0]) for d in self.data), dtype=np.int64,
+                           count=len(self.data)),
+               np.fromiter((len(d[1]) for d in self.data), dtype=np.int64,
+                           count=len(self.data)))
         
     @classmethod
     def from_files(cls, src_files: list[str], tgt_files: list[str], 
-                   min_freq: int = 1, encoding: str = 'utf8'):
+                   min_freq: int = 1, encoding: str = 'utf8',
+                   src_vocab: Optional[Vocabulary] = None,
+                   tgt_vocab: Optional[Vocabulary] = None,
+                   workers: Optional[int] = 1,
+                   cache_file: Optional[str] = None,
+                   filter_oov: bool = False,
+                   align_files: Optional[list[str]] = None,
+                   max_len: Optional[int] = None):
+        """
+        Builds a dataset from parallel source and target files, which may
+        be compressed (see fileio.open_text). Vocabularies are built from
+        the files unless given (e.g. from Vocabulary.load); see
+        Vocabulary.from_files for workers and cache_file. With filter_oov,
+        pairs with characters outside either vocabulary, or with a
+        whitespace-only side, are dropped (see vocab.CharFilter).
+        
+        Pairs with more than max_len tokens on either side are cut into
+        aligned windows (see alignment.aligned_windows), using the
+        alignment files of the source files, as written by
+        generate_romanization.py --align_dir or, for split files, by
+        clean_and_split_data.py --align_dir.
+
+        """
+        if max_len is not None and align_files is None:
+            raise ValueError("max_len needs align_files.")
+        
         # make source and target vocab objects
-        src_vocab = Vocabulary.from_files(src_files, specials = [PAD],
-                                          min_freq = min_freq)
-        tgt_vocab = Vocabulary.from_files(tgt_files, specials = [PAD],
-                                          min_freq = min_freq)
+        if src_vocab is None:
+            src_vocab = Vocabulary.from_files(src_files, encoding, workers,
+                                              cache_file, specials = [PAD],
+                                              min_freq = min_freq)
+        if tgt_vocab is None:
+            tgt_vocab = Vocabulary.from_files(tgt_files, encoding, workers,
+                                              cache_file, specials = [PAD],
+                                              min_freq = min_freq)
         
-        # convert files to list of indices
+        filters = (CharFilter.from_vocab(src_vocab),
+                   CharFilter.from_vocab(tgt_vocab)) if filter_oov else None
+        
+        # convert files to arrays of indices
         data: list[Datum] = []
+        stage = STATS.stage("dataset")
         for i in range(len(src_files)):
-            src_lines = open(src_files[i], encoding=encoding).readlines()
-            tgt_lines = open(tgt_files[i], encoding=encoding).readlines()
+            with stage.time():
+                with open_text(src_files[i], encoding=encoding) as f:
+                    src_lines = f.readlines()
+                with open_text(tgt_files[i], encoding=encoding) as f:
+                    tgt_lines = f.readlines()
+                rows = (src_lines, tgt_lines)
+                if max_len is not None:
+                    with open_text(align_files[i]) as f:
+                        rows += (f.readlines(),)
+                        
+                lines = len(src_lines)
+                if filters is not None:
+                    rows = _filter_rows(rows, filters)
+                kept = len(rows[0])
+                src_lines, tgt_lines = _window_rows(rows, max_len)
             
-            for j in range(len(src_lines)):
-                # make lists of chars
-                src = list(''.join(src_lines[j].split()))
-                tgt = list(''.join(tgt_lines[j].split()))
-                
-                data.append([src_vocab.tokens_to_indices(src), 
-                             tgt_vocab.tokens_to_indices(tgt)])
+                data.extend(zip(src_vocab.encode_batch(src_lines),
+                                tgt_vocab.encode_batch(tgt_lines)))
+            stage.add(files=1, lines=lines, dropped=lines - kept,
+                      windows=len(src_lines))
                 
         return RomanizationDataset(data, src_vocab, tgt_vocab)  
     
+class MemmapRomanizationDataset(Dataset):
+    def __init__(self, data_dir: str, split: str = "train") -> None:
+        """
+        Dataset backed by the tokenized format written by write_tokenized.
+        Token and offset arrays are opened with numpy.memmap, so startup
+        is immediate and all DataLoader workers share the same pages.
+        Items are (source, target) zero-copy slices of the token arrays.
+
+        Parameters
+        ----------
+        data_dir : str
+            directory containing src_vocab.json, tgt_vocab.json and one
+            subdirectory per split
+        split : str, optional
+            name of the split to open. default is "train"
+
+        """
+        super().__init__()
+        self.data_dir = data_dir
+        self.split = split
+        self.src_vocab = Vocabulary.load(f"{data_dir}/src_vocab.json")
+        self.tgt_vocab = Vocabulary.load(f"{data_dir}/tgt_vocab.json")
+        
+        with open(f"{data_dir}/{split}/meta.json", encoding="utf8") as f:
+            self.meta = json.load(f)
+            
+        self._open()
+        
+    def _open(self) -> None:
+        path = f"{self.data_dir}/{self.split}"
+        dtype = np.dtype(self.meta["dtype"])
+        self.tokens = {}
+        self.offsets = {}
+        
+        for side in SIDES:
+            self.offsets[side] = np.memmap(f"{path}/{side}.offsets",
+                                           dtype=np.int64, mode="r")
+            # np.memmap cannot map empty files
+            if self.offsets[side][-1] > 0:
+                self.tokens[side] = np.memmap(f"{path}/{side}.tokens",
+                                              dtype=dtype, mode="r")
+            else:
+                self.tokens[side] = np.zeros(0, dtype=dtype)
+                
+    def __getitem__(self, index) -> tuple[np.ndarray, np.ndarray]:
+        src, tgt = self.tokens["src"], self.tokens["tgt"]
+        src_off, tgt_off = self.offsets["src"], self.offsets["tgt"]
+        return(src[src_off[index]:src_off[index + 1]],
+               tgt[tgt_off[index]:tgt_off[index + 1]])
+    
+    def __len__(self) -> int:
+        return(self.meta["num_examples"])
+    
+    def lengths(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns arrays of source and target lengths for all examples
+
+        """
+        return(np.diff(self.offsets["src"]), np.diff(self.offsets["tgt"]))
+    
+    def __getstate__(self) -> dict:
+        # workers reopen the maps instead of receiving a pickled copy
+        state = self.__dict__.copy()
+        del state["tokens"], state["offsets"]
+        return(state)
+    
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._open()
+
+
+class StreamingRomanizationDataset(IterableDataset):
+    def __init__(self, src_files: list[str], tgt_files: list[str],
+                 src_vocab: Vocabulary, tgt_vocab: Vocabulary,
+                 encoding: str = 'utf8', shuffle_buffer: int = 0,
+                 seed: int = 0, rank: Optional[int] = None,
+                 world_size: Optional[int] = None,
+                 filter_oov: bool = False,
+                 align_files: Optional[list[str]] = None,
+                 max_len: Optional[int] = None) -> None:
+        """
+        Iterable dataset that reads parallel source and target files
+        lazily and encodes them with the given vocabularies, so training
+        can start without loading the corpus.
+
+        Work is split into one shard per DataLoader worker and training
+        process. With at least as many files as shards, whole files are
+        balanced across shards by size; otherwise every file is cut into
+        line-aligned byte ranges, one per shard, cut at every
+        INDEX_LINES-th line; the offsets of those lines are indexed once,
+        when the dataset is created. Files therefore have to be
+        uncompressed.
+
+        Parameters
+        ----------
+        src_files, tgt_files : list[str]
+            parallel files with the same number of lines
+        src_vocab, tgt_vocab : Vocabulary
+            vocabularies used for encoding
+        encoding : str, optional
+            default is 'utf8'; must keep newlines as single bytes
+        shuffle_buffer : int, optional
+            size of the shuffle buffer; 0 keeps file order
+        seed : int, optional
+            base seed; each shard and epoch uses (seed, epoch, shard)
+        rank, world_size : int, optional
+            training process index and count; taken from
+            torch.distributed when it is initialized, else 0 and 1
+        filter_oov : bool, optional
+            drop pairs with characters outside either vocabulary, or with
+            a whitespace-only side (see vocab.CharFilter)
+        align_files : list[str], optional
+            alignments of the source files, as written by
+            generate_romanization.py or clean_and_split_data.py with
+            --align_dir; needed for max_len
+        max_len : int, optional
+            cut pairs with more tokens on either side into aligned
+            windows (see alignment.aligned_windows)
+
+        """
+        super().__init__()
+        self.src_files = src_files
+        self.tgt_files = tgt_files
+        self.src_vocab = src_vocab
+        self.tgt_vocab = tgt_vocab
+        self.encoding = encoding
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.align_files = align_files
+        self.max_len = max_len
+        self.epoch = 0
+        # one filter per file in a group, see _file_groups
+        self.char_filters = (CharFilter.from_vocab(src_vocab),
+                             CharFilter.from_vocab(tgt_vocab)) \
+            if filter_oov else None
+        self.line_index = {f: _line_index(f) for group in self._file_groups()
+                           for f in group}
+        
+    def set_epoch(self, epoch: int) -> None:
+        """
+        Sets the epoch used for shuffling; call before each epoch.
+
+        """
+        self.epoch = epoch
+        
+    def _shard(self) -> tuple[int, int]:
+        """
+        Returns (shard index, number of shards) for the calling worker
+
+        """
+        rank, world_size = self.rank, self.world_size
+        if rank is None or world_size is None:
+            if torch.distributed.is_available() \
+                and torch.distributed.is_initialized():
+                rank = torch.distributed.get_rank()
+                world_size = torch.distributed.get_world_size()
+            else:
+                rank, world_size = 0, 1
+                
+        worker = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker is None \
+            else (worker.id, worker.num_workers)
+        
+        return(rank * num_workers + worker_id, world_size * num_workers)
+    
+    def _file_groups(self) -> list[tuple[str, ...]]:
+        """
+        Returns the groups of parallel files read together
+
+        """
+        if self.max_len is not None:
+            if self.align_files is None:
+                raise ValueError("max_len needs align_files.")
+            return(list(zip(self.src_files, self.tgt_files,
+                            self.align_files)))
+        return(list(zip(self.src_files, self.tgt_files)))
+    
+    def _ranges(self, shard: int, num_shards: int) -> list[list[tuple]]:
+        """
+        Returns, for every file group read by a shard, a list of
+        (file, start, end) byte ranges covering the same lines
+
+        """
+        groups = self._file_groups()
+        
+        if len(groups) >= num_shards:
+            # greedy balance by size; the same on every worker
+            loads = [0] * num_shards
+            ranges = []
+            by_size = sorted(groups, key=lambda g: -os.path.getsize(g[0]))
+            for group in by_size:
+                target = loads.index(min(loads))
+                loads[target] += os.path.getsize(group[0])
+                if target == shard:
+                    ranges.append([(f, 0, os.path.getsize(f))
+                                   for f in group])
+            return(ranges)
+        
+        ranges = []
+        for group in groups:
+            # cut only at lines indexed in every file, closest to an equal
+            # split of the first file's bytes
+            cuts = min(len(self.line_index[f]) for f in group)
+            indices = [self.line_index[f][:cuts] for f in group]
+            size = os.path.getsize(group[0])
+            lo = np.searchsorted(indices[0], size * shard // num_shards)
+            hi = np.searchsorted(indices[0],
+                                 size * (shard + 1) // num_shards)
+            if shard == num_shards - 1:
+                hi = cuts
+            
+            ranges.append([(f, _offset(index, lo, f), _offset(index, hi, f))
+                           for f, index in zip(group, indices)])
+        return(ranges)
+    
+    def _encode_chunk(self, lines: tuple[tuple[str, ...], ...],
+                      rng: np.random.Generator) -> Iterable[Datum]:
+        """
+        Encodes a chunk of (source lines, target lines[, alignments])
+
+        """
+        src_lines, tgt_lines = _window_rows(lines, self.max_len)
+        return(zip(self.src_vocab.encode_batch(src_lines),
+                   self.tgt_vocab.encode_batch(tgt_lines)))
+    
+    def __iter__(self):
+        shard, num_shards = self._shard()
+        rng = np.random.default_rng([self.seed, self.epoch, shard])
+        buffer = []
+        # counts stay in the DataLoader worker process that iterates
+        stage = STATS.stage("stream")
+        
+        for group in self._ranges(shard, num_shards):
+            chunks = [([line.decode(self.encoding) for line in chunk]
+                       for chunk in iter_line_range(f, start, end))
+                      for f, start, end in group]
+            
+            for rows in _iter_row_chunks(chunks):
+                with stage.time():
+                    lines = tuple(zip(*rows))
+                    if self.char_filters is not None:
+                        lines = _filter_rows(lines, self.char_filters)
+                    encoded = list(self._encode_chunk(lines, rng)) \
+                        if lines[0] else []
+                stage.add(lines=len(rows), dropped=len(rows) - len(lines[0]),
+                          windows=len(encoded))
+                for datum in encoded:
+                    if self.shuffle_buffer <= 0:
+                        yield datum
+                    elif len(buffer) < self.shuffle_buffer:
+                        buffer.append(datum)
+                    else:
+                        i = rng.integers(len(buffer))
+                        yield buffer[i]
+                        buffer[i] = datum
+                        
+        rng.shuffle(buffer)
+        yield from buffer
+        
+        
+class OnTheFlyRomanizationDataset(StreamingRomanizationDataset):
+    def __init__(self, tgt_files: list[str], romanizer, 
+                 tgt_vocab: Vocabulary,
+                 src_vocab: Optional[Vocabulary] = None,
+                 encoding: str = 'utf8', shuffle_buffer: int = 0,
+                 seed: int = 0, rank: Optional[int] = None,
+                 world_size: Optional[int] = None,
+                 filter_oov: bool = False,
+                 max_len: Optional[int] = None) -> None:
+        """
+        Streaming dataset that only reads the original-orthography corpus
+        and romanizes it inside the DataLoader workers, giving a fresh
+        noise sample of every sentence each epoch. Sampling is seeded by
+        (seed, epoch, shard), so runs are reproducible; call set_epoch
+        before each epoch.
+
+        Parameters
+        ----------
+        tgt_files : list[str]
+            corpus in original orthography
+        romanizer : Romanizer
+            romanizer from generate_romanization.py, see from_key
+        tgt_vocab : Vocabulary
+            target vocabulary
+        src_vocab : Vocabulary, optional
+            source vocabulary; by default built with romanized_vocab
+
+        See StreamingRomanizationDataset for the other parameters;
+        filter_oov only checks the target side, before romanization, and
+        max_len uses the alignments of the fresh romanizations.
+
+        """
+        if src_vocab is None:
+            src_vocab = romanized_vocab(romanizer, tgt_vocab)
+            
+        super().__init__([], tgt_files, src_vocab, tgt_vocab, encoding,
+                         shuffle_buffer, seed, rank, world_size,
+                         max_len=max_len)
+        self.romanizer = romanizer
+        self.char_filters = (CharFilter.from_vocab(tgt_vocab),) \
+            if filter_oov else None
+        
+    def _file_groups(self) -> list[tuple[str, ...]]:
+        return([(f,) for f in self.tgt_files])
+    
+    def _encode_chunk(self, lines: tuple[tuple[str, ...], ...],
+                      rng: np.random.Generator) -> Iterable[Datum]:
+        tgt_lines, = lines
+        if self.max_len is None:
+            src_lines = self.romanizer.romanize_batch(tgt_lines, rng)
+        else:
+            src_lines, alignments = self.romanizer.romanize_batch(
+                tgt_lines, rng, align=True)
+            src_lines, tgt_lines = _window_rows(
+                (src_lines, tgt_lines, alignments), self.max_len)
+        return(zip(self.src_vocab.encode_batch(src_lines),
+                   self.tgt_vocab.encode_batch(tgt_lines)))
+    
+    @classmethod
+    def from_key(cls, key_file: str, tgt_files: list[str],
+                 tgt_vocab: Vocabulary, prop_typical: float = 0.9,
+                 encoding: str = 'utf8', **kwargs):
+        """
+        Builds the dataset with a Romanizer read from a key file. Needs
+        /Preprocessing/ on the path.
+
+        """
+        from generate_romanization import Romanizer
+        
+        romanizer = Romanizer.from_file(key_file, prop_typical,
+                                        encoding=encoding)
+        return(cls(tgt_files, romanizer, tgt_vocab, encoding=encoding,
+                   **kwargs))
+    
+    
+def romanized_vocab(romanizer, tgt_vocab: Vocabulary) -> Vocabulary:
+    """
+    Builds a source vocabulary covering every character a romanizer can
+    produce from text in tgt_vocab: the characters of all candidates,
+    plus target characters without a key entry, which are copied through.
+
+    """
+    chars = set(''.join(romanizer.cand_table.tolist()))
+    chars.update(t for t in tgt_vocab.index_to_token
+                 if len(t) == 1 and t not in tgt_vocab.specials
+                 and t not in romanizer.char_probs)
+    chars = sorted(c for c in chars if not c.isspace())
+    
+    return(Vocabulary(Counter(chars), specials=[PAD]))
+        
+
+def _line_index(file: str, step: int = INDEX_LINES) -> np.ndarray:
+    """
+    Returns the byte offsets of lines 0, step, 2 * step, ... of a file
+
+    """
+    offsets = [np.zeros(1, dtype=np.int64)]
+    pos = 0
+    # newlines left until the next indexed line
+    needed = step
+    with open(file, 'rb') as f:
+        for data in iter(lambda: f.read(IO_BUFFER), b''):
+            newlines = np.flatnonzero(np.frombuffer(data, dtype=np.uint8)
+                                      == ord('\n'))
+            offsets.append(pos + newlines[needed - 1::step] + 1)
+            needed = (needed - len(newlines) - 1) % step + 1
+            pos += len(data)
+    return(np.concatenate(offsets))
+
+
+def _offset(index: np.ndarray, k: int, file: str) -> int:
+    # offset of the k-th indexed line, or the end of the file past them
+    return(int(index[k]) if k < len(index) else os.path.getsize(file))
+    
+    
+def _filter_rows(lines: tuple, filters: tuple) -> tuple:
+    """
+    Keeps the rows of parallel line lists that pass every side's filter
+
+    """
+    keep = np.logical_and.reduce([f.mask(side) for f, side in
+                                  zip(filters, lines)])
+    return(tuple([line for line, k in zip(side, keep) if k]
+                 for side in lines))
+
+
+def _window_rows(rows: tuple, max_len: Optional[int]
+                 ) -> tuple[list[str], list[str]]:
+    """
+    Cuts the pairs of (source lines, target lines, alignments) with more
+    than max_len tokens on either side into aligned windows; alignments
+    may be arrays or lines of an alignment file. Returns the source and
+    target lines, unchanged if max_len is None.
+
+    """
+    if max_len is None:
+        return(rows[0], rows[1])
+    
+    src_windows, tgt_windows = [], []
+    for src, tgt, alignment in zip(*rows):
+        # a line has at least as many characters as tokens
+        if len(src) <= max_len and len(tgt) <= max_len:
+            src_windows.append(src)
+            tgt_windows.append(tgt)
+            continue
+        if isinstance(alignment, str):
+            alignment = parse_alignment(alignment)
+        for src_window, tgt_window in aligned_windows(src, tgt, alignment,
+                                                      max_len):
+            src_windows.append(src_window)
+            tgt_windows.append(tgt_window)
+    return(src_windows, tgt_windows)
+
+
+def _iter_row_chunks(chunks: list):
+    """
+    Re-chunks parallel streams of line lists into lists of rows, where
+    each row holds one line from every stream
+
+    """
+    rows = zip(*[chain.from_iterable(c) for c in chunks])
+    return(iter(lambda: list(islice(rows, CHUNK_LINES)), []))
+
+
+def write_tokenized(out_dir: str, split: str, src_files: list[str],
+                    tgt_files: list[str], src_vocab: Vocabulary,
+                    tgt_vocab: Vocabulary, encoding: str = 'utf8') -> int:
+    """
+    Tokenizes parallel source and target files once and writes them to
+    out_dir/split as a flat token array and an offsets array per side,
+    for use with MemmapRomanizationDataset. The vocabularies are saved
+    to out_dir. Returns the number of examples written.
+
+    """
+    path = Path(out_dir, split)
+    path.mkdir(parents=True, exist_ok=True)
+    src_vocab.save(f"{out_dir}/src_vocab.json")
+    tgt_vocab.save(f"{out_dir}/tgt_vocab.json")
+    
+    vocab_size = max(len(src_vocab), len(tgt_vocab))
+    dtype = np.dtype(np.uint16 if vocab_size <= 2**16 else np.int32)
+    vocabs = {"src": src_vocab, "tgt": tgt_vocab}
+    
+    token_files = {side: open(path / f"{side}.tokens", "wb")
+                   for side in SIDES}
+    offsets = {side: [np.zeros(1, dtype=np.int64)] for side in SIDES}
+    stage = STATS.stage("tokenize")
+    
+    try:
+        for src_file, tgt_file in zip(src_files, tgt_files):
+            stage.add(files=1)
+            with open_text(src_file, encoding=encoding) as src, \
+                open_text(tgt_file, encoding=encoding) as tgt:
+                pairs = zip(src, tgt)
+                for chunk in iter(lambda: list(islice(pairs, CHUNK_LINES)),
+                                  []):
+                    stage.add(lines=len(chunk))
+                    for side, lines in zip(SIDES, zip(*chunk)):
+                        indices, chunk_offsets = vocabs[side].encode_batch(
+                            lines, return_offsets=True)
+                        indices.astype(dtype).tofile(token_files[side])
+                        offsets[side].append(chunk_offsets[1:]
+                                             + offsets[side][-1][-1])
+    finally:
+        for file in token_files.values():
+            file.close()
+            
+    for side in SIDES:
+        offsets[side] = np.concatenate(offsets[side])
+        offsets[side].tofile(path / f"{side}.offsets")
+        
+    num_examples = len(offsets["src"]) - 1
+    with open(path / "meta.json", "w", encoding="utf8") as f:
+        json.dump({"num_examples": num_examples, "dtype": dtype.name}, f)
+        
+    return(num_examples)
+
+    
+class Batch(NamedTuple):
+    source: Tensor
+    target: Tensor
+    source_lengths: Tensor
+    target_lengths: Tensor
+    source_mask: Tensor
+    target_mask: Tensor
+    
+
+def pad_sequences(sequences: list) -> tuple[Tensor, Tensor, Tensor]:
+    """
+    Pads index sequences into a preallocated int64 tensor with pad
+    index 0. Returns the padded tensor, the lengths and a boolean mask
+    that is True at real (non-padding) positions.
+
+    """
+    lengths = torch.tensor([len(s) for s in sequences], dtype=torch.int64)
+    max_len = int(lengths.max()) if len(sequences) > 0 else 0
+    
+    padded = torch.zeros((len(sequences), max_len), dtype=torch.int64)
+    mask = torch.arange(max_len) < lengths[:, None]
+    
+    # the mask is filled row by row, in the same order as the concatenation
+    if max_len > 0:
+        flat = np.concatenate([np.asarray(s, dtype=np.int64)
+                               for s in sequences])
+        padded[mask] = torch.from_numpy(flat)
+        
+    return(padded, lengths, mask)
+
+
+class BucketBatchSampler(Sampler):
+    def __init__(self, src_lengths: np.ndarray, tgt_lengths: np.ndarray,
+                 batch_size: int = 256, max_tokens: Optional[int] = None,
+                 pool_size: int = 100, shuffle: bool = True, seed: int = 0,
+                 drop_last: bool = False) -> None:
+        """
+        Batch sampler that groups examples of similar source and target
+        length to reduce padding. Each epoch, examples are shuffled and cut
+        into pools of pool_size batches' worth of examples; each pool is
+        sorted by length and cut into batches, and the order of all
+        batches is shuffled.
+
+        The padding ratio (share of padded positions in the batch tensors)
+        of each epoch is appended to padding_ratios.
+
+        Parameters
+        ----------
+        src_lengths, tgt_lengths : np.ndarray
+            lengths of every example, e.g. from dataset.lengths()
+        batch_size : int, optional
+            number of examples per batch. default is 256
+        max_tokens : int, optional
+            if given, batches are instead filled up to this many tokens,
+            counted as batch size * longest sequence on either side
+        pool_size : int, optional
+            number of batches sorted together. default is 100
+        shuffle : bool, optional
+            default is True
+        seed : int, optional
+            base seed; each epoch uses (seed, epoch)
+        drop_last : bool, optional
+            drop batches smaller than batch_size (fixed-size batches only)
+
+        """
+        self.src_lengths = np.asarray(src_lengths, dtype=np.int64)
+        self.tgt_lengths = np.asarray(tgt_lengths, dtype=np.int64)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.pool_size = pool_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+        self.padding_ratios = []
+        self._cache = None
+        
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+        
+    def _batches(self) -> list[np.ndarray]:
+        if self._cache is not None and self._cache[0] == self.epoch:
+            return(self._cache[1])
+        
+        rng = np.random.default_rng([self.seed, self.epoch])
+        n = len(self.src_lengths)
+        order = rng.permutation(n) if self.shuffle else np.arange(n)
+        longest = np.maximum(self.src_lengths, self.tgt_lengths)
+        
+        if self.max_tokens is None:
+            pool = self.batch_size * self.pool_size
+        else:
+            pool = max(1, self.max_tokens * self.pool_size
+                       // max(1, int(longest.mean() if n else 1)))
+        
+        batches = []
+        for start in range(0, n, pool):
+            chunk = order[start:start + pool]
+            chunk = chunk[np.lexsort((self.tgt_lengths[chunk],
+                                      self.src_lengths[chunk]))]
+            
+            if self.max_tokens is None:
+                for i in range(0, len(chunk), self.batch_size):
+                    batch = chunk[i:i + self.batch_size]
+                    if len(batch) == self.batch_size or not self.drop_last:
+                        batches.append(batch)
+            else:
+                # grow each batch while its padded size fits the budget
+                begin = 0
+                batch_max = 0
+                for i, index in enumerate(chunk):
+                    new_max = max(batch_max, longest[index])
+                    if i > begin and new_max * (i - begin + 1) \
+                        > self.max_tokens:
+                        batches.append(chunk[begin:i])
+                        begin = i
+                        new_max = longest[index]
+                    batch_max = new_max
+                if begin < len(chunk):
+                    batches.append(chunk[begin:])
+        
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+            
+        self._cache = (self.epoch, batches)
+        return(batches)
+    
+    def padding_ratio(self, batches: list[np.ndarray]) -> float:
+        """
+        Returns the share of padded positions over both sides in batches
+
+        """
+        padded = 0
+        real = 0
+        for batch in batches:
+            for lengths in (self.src_lengths, self.tgt_lengths):
+                batch_lengths = lengths[batch]
+                padded += len(batch) * batch_lengths.max()
+                real += batch_lengths.sum()
+        return(float(1 - real / padded) if padded > 0 else 0.0)
+        
+    def __iter__(self):
+        batches = self._batches()
+        self.padding_ratios.append(self.padding_ratio(batches))
+        
+        # without set_epoch calls, every pass still gets a new order
+        self.epoch += 1
+        for batch in batches:
+            yield batch.tolist()
+            
+    def __len__(self) -> int:
+        return(len(self._batches()))
+
+    
 class RomanizationDataLoader(DataLoader):
-    def __init__(self, data: RomanizationDataset, batch_size: int = 256, **kwargs):
+    def __init__(self, data: RomanizationDataset, batch_size: int = 256,
+                 bucket: bool = False, max_tokens: Optional[int] = None,
+                 seed: int = 0, **kwargs):
+        """
+        DataLoader that pads batches with index 0. With bucket=True or
+        max_tokens set, batches come from a BucketBatchSampler over the
+        dataset's lengths(); its per-epoch padding ratios are available
+        as padding_ratios.
+
+        """
         self.dataset = data
-        super().__init__(self.dataset, batch_size = batch_size,
-                         shuffle=True, collate_fn = self.pad_batches,
-                         **kwargs)
+        self.bucket_sampler = None
+        
+        if isinstance(data, IterableDataset):
+            # streaming datasets shuffle and shard themselves
+            if bucket or max_tokens is not None:
+                raise ValueError("Bucketing needs a map-style dataset.")
+            super().__init__(self.dataset, batch_size = batch_size,
+                             collate_fn = self.pad_batches, **kwargs)
+        elif bucket or max_tokens is not None:
+            self.bucket_sampler = BucketBatchSampler(
+                *data.lengths(), batch_size=batch_size,
+                max_tokens=max_tokens, seed=seed)
+            super().__init__(self.dataset,
+                             batch_sampler = self.bucket_sampler,
+                             collate_fn = self.pad_batches, **kwargs)
+        else:
+            super().__init__(self.dataset, batch_size = batch_size,
+                             shuffle=True, collate_fn = self.pad_batches,
+                             **kwargs)
+            
+    @property
+    def padding_ratios(self) -> list[float]:
+        if self.bucket_sampler is None:
+            return([])
+        return(self.bucket_sampler.padding_ratios)
     
     @classmethod
-    def pad_batches(cls, samples):
-        # pad index must be 0
-        x = [s[0] for s in samples]
-        y = [s[1] for s in samples]
+    def pad_batches(cls, samples) -> Batch:
+        """
+        Collates (source, target) samples into a Batch of int64 tensors
+        padded with index 0, plus lengths and masks (True for real
+        tokens). Samples are copied, never modified.
+
+        """
+        stage = STATS.stage("collate")
+        with stage.time():
+            src, src_lengths, src_mask = pad_sequences(
+                [s[0] for s in samples])
+            tgt, tgt_lengths, tgt_mask = pad_sequences(
+                [s[1] for s in samples])
+        stage.add(batches=1, lines=len(samples))
         
-        max_x_len = max([len(s) for s in x])
-        max_y_len = max([len(s) for s in y])
-    
-        for s in x:
-            while len(s) < max_x_len:
-                s.append(0)
-                
-        for s in y:
-            while len(s) < max_y_len:
-                s.append(0)
-                
-        return Tensor(x), Tensor(y)
+        return Batch(src, tgt, src_lengths, tgt_lengths, src_mask, tgt_mask)
     
     @classmethod
     def from_files(cls, src_files: list[str], tgt_files: list[str],
@@ -0,0 +1,261 @@
+"""
+    Module for reading and writing text files that may be compressed.
+
+    The compression is chosen by file extension: .gz, .bz2, .xz and, if
+    the zstandard package is installed, .zst. Files of all four formats
+    may consist of several concatenated streams (members, frames), so
+    files compressed in parts can simply be joined. Multi-stream bz2
+    files, such as Wikipedia's multistream dumps, can be decompressed by
+    several processes at once.
+"""
+
+import bz2, gzip, io, lzma, mmap, os, re
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Iterator
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# constants
+COMPRESSED = (".gz", ".bz2", ".xz", ".zst")
+# buffer size for reading and writing files
+IO_BUFFER = 2**20
+# approximate number of compressed bytes per parallel bz2 job
+BZ2_JOB_SIZE = 2**24
+
+# start of a bz2 stream followed by the magic number of its first block
+re_bz2_stream = re.compile(rb"BZh[1-9]1AY&SY")
+
+
+def compression(file: str) -> str:
+    """
+    Returns the compression extension of file, or "" if it is not
+    compressed
+
+    """
+    suffix = Path(file).suffix.lower()
+    return(suffix if suffix in COMPRESSED else "")
+
+
+def with_compression(file: str, ext: str) -> str:
+    """
+    Replaces the compression extension of file (if any) with ext, which
+    may be "" for no compression
+
+    """
+    if ext and not ext.startswith("."):
+        ext = "." + ext
+    if ext and ext not in COMPRESSED:
+        raise ValueError(f"Unknown compression {ext}, expected one of "
+                         f"{', '.join(COMPRESSED)}.")
+    current = compression(file)
+    return((file[:-len(current)] if current else file) + ext)
+
+
+def _open_binary(file: str, mode: str, source=None):
+    # source: binary file object to use instead of opening file
+    ext = compression(file)
+    target = source if source is not None else file
+    if ext == ".gz":
+        return(gzip.open(target, mode, compresslevel=6))
+    if ext == ".bz2":
+        return(bz2.open(target, mode))
+    if ext == ".xz":
+        return(lzma.open(target, mode))
+    if ext == ".zst":
+        if zstandard is None:
+            raise ImportError(
+                f"Reading or writing {file} needs the zstandard package.")
+        fh = source if source is not None else open(file, mode)
+        if "r" in mode:
+            return(zstandard.ZstdDecompressor().stream_reader(
+                fh, read_across_frames=True, closefd=True))
+        return(zstandard.ZstdCompressor().stream_writer(fh, closefd=True))
+    return(source if source is not None else open(file, mode, buffering=0))
+
+
+class HashingReader(io.RawIOBase):
+    def __init__(self, raw, digest) -> None:
+        """
+        Raw reader that passes every byte it reads to digest.update,
+        e.g. to hash a file while it is decompressed.
+
+        """
+        self.raw = raw
+        self.digest = digest
+
+    def readable(self) -> bool:
+        return(True)
+
+    def readinto(self, buffer) -> int:
+        n = self.raw.readinto(buffer)
+        self.digest.update(memoryview(buffer)[:n])
+        return(n)
+
+    def close(self) -> None:
+        self.raw.close()
+        super().close()
+
+
+class _SourceReader(io.BufferedReader):
+    # also closes the file under a decompressor, which does not own it
+    def __init__(self, raw, source, buffering: int) -> None:
+        super().__init__(raw, buffering)
+        self._source = source
+
+    def close(self) -> None:
+        try:
+            super().close()
+        finally:
+            self._source.close()
+
+
+def open_text(file: str, mode: str = "r", encoding: str = "utf8",
+              buffering: int = IO_BUFFER, workers: int = 1, digest=None):
+    """
+    Opens a plain or compressed text file, based on its extension.
+
+    Parameters
+    ----------
+    file : str
+        file name
+    mode : str, optional
+        "r", "w" or "a". default is "r"
+    encoding : str, optional
+        text encoding. default is utf8
+    buffering : int, optional
+        buffer size in bytes
+    workers : int, optional
+        number of processes used to decompress multi-stream bz2 files;
+        must be 1 inside daemonic processes such as Pool workers
+    digest : hashlib hash object, optional
+        in mode "r", updated with the bytes of the file (compressed, if
+        it is) as they are read; reading the text to its end reads the
+        whole file
+
+    """
+    if mode not in ("r", "w", "a"):
+        raise ValueError(f"Unsupported mode {mode}.")
+    if digest is not None:
+        if mode != "r":
+            raise ValueError("A digest can only be computed in mode 'r'.")
+        source = HashingReader(open(file, "rb", buffering=0), digest)
+        raw = _SourceReader(_open_binary(file, "rb", source), source,
+                            buffering)
+        return(io.TextIOWrapper(raw, encoding=encoding))
+    if not compression(file):
+        return(open(file, mode, encoding=encoding, buffering=buffering))
+
+    if mode == "r" and workers > 1 and compression(file) == ".bz2":
+        raw = io.BufferedReader(ParallelBZ2Reader(file, workers),
+                                buffering)
+    elif mode == "r":
+        raw = io.BufferedReader(_open_binary(file, "rb"), buffering)
+    else:
+        raw = io.BufferedWriter(_open_binary(file, mode + "b"), buffering)
+    return(io.TextIOWrapper(raw, encoding=encoding))
+
+
+def iter_line_range(file: str, start: int, end: int,
+                    chunk_size: int = IO_BUFFER) -> Iterator[list[bytes]]:
+    """
+    Yields lists of undecoded lines from bytes [start, end) of an
+    uncompressed file, about chunk_size bytes at a time. start and end
+    should be line boundaries; a line that starts before end is yielded
+    whole.
+
+    """
+    with open(file, "rb", buffering=IO_BUFFER) as f:
+        f.seek(start)
+        pos = start
+        while pos < end:
+            lines = f.readlines(min(chunk_size, end - pos))
+            if not lines:
+                break
+
+            # readlines may return one line past the end of the range
+            chunk = []
+            for line in lines:
+                if pos >= end:
+                    break
+                chunk.append(line)
+                pos += len(line)
+            yield chunk
+
+
+def _decompress_bz2_range(task: tuple[str, int, int]) -> bytes:
+    file, start, end = task
+    with open(file, "rb") as f:
+        f.seek(start)
+        return(bz2.decompress(f.read(end - start)))
+
+
+class ParallelBZ2Reader(io.RawIOBase):
+    def __init__(self, file: str, workers: int,
+                 job_size: int = BZ2_JOB_SIZE) -> None:
+        """
+        Reads a multi-stream bz2 file by decompressing groups of streams
+        of about job_size bytes in a process pool, in order. At most
+        2 * workers groups are decompressed ahead of the reader. A file
+        with a single stream is streamed by the calling process.
+
+        """
+        self.file = file
+        self.workers = workers
+        self.ranges = self._plan(job_size)
+        self._blocks = self._iter_blocks()
+        self._block = memoryview(b"")
+
+    def _plan(self, job_size: int) -> list[tuple[int, int]]:
+        size = os.path.getsize(self.file)
+        if size == 0:
+            return([])
+        with open(self.file, "rb") as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            starts = [m.start() for m in re_bz2_stream.finditer(data)]
+
+        bounds = [0]
+        for start in starts:
+            if start - bounds[-1] >= job_size:
+                bounds.append(start)
+        bounds.append(size)
+        return(list(zip(bounds[:-1], bounds[1:])))
+
+    def _iter_blocks(self) -> Iterator[bytes]:
+        tasks = [(self.file, start, end) for start, end in self.ranges]
+        if len(tasks) <= 1:
+            with bz2.open(self.file, "rb") as f:
+                yield from iter(lambda: f.read(IO_BUFFER), b"")
+            return
+
+        with ProcessPoolExecutor(self.workers) as pool:
+            pending = deque()
+            for task in tasks:
+                pending.append(pool.submit(_decompress_bz2_range, task))
+                if len(pending) >= 2 * self.workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def readable(self) -> bool:
+        return(True)
+
+    def readinto(self, buffer) -> int:
+        while len(self._block) == 0:
+            block = next(self._blocks, None)
+            if block is None:
+                return(0)
+            self._block = memoryview(block)
+        n = min(len(buffer), len(self._block))
+        buffer[:n] = self._block[:n]
+        self._block = self._block[n:]
+        return(n)
+
+    def close(self) -> None:
+        self._blocks.close()
+        super().close()
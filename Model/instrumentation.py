@@ -0,0 +1,277 @@
+"""
+    Module for lightweight per-stage instrumentation shared by the
+    preprocessing scripts and the data loaders.
+
+    Code reports work through the module-level STATS object:
+
+        stage = STATS.stage("romanize")
+        with stage.time():
+            ...
+        stage.add(lines=len(chunk), chars=num_chars)
+
+    While STATS is disabled (the default), stage() returns a shared no-op
+    object, so instrumented code costs one attribute lookup per call.
+    Scripts enable it through the --profile, --progress and --stats
+    options added by add_arguments.
+"""
+
+import cProfile, json, math, os, sys, threading, time
+
+from argparse import ArgumentParser, Namespace
+from collections import Counter, defaultdict
+from contextlib import contextmanager, nullcontext
+from typing import Optional
+
+
+class Histogram:
+    def __init__(self) -> None:
+        """
+        Histogram of durations with power-of-two buckets, keyed by their
+        upper bound in seconds
+
+        """
+        self.buckets = Counter()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float) -> None:
+        self.buckets[math.frexp(max(seconds, 1e-9))[1]] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def to_dict(self) -> dict:
+        return({"count": self.count, "total": self.total, "max": self.max,
+                "buckets": {str(2.0 ** e): n for e, n in
+                            sorted(self.buckets.items())}})
+
+    def merge(self, other: dict) -> None:
+        for bound, n in other["buckets"].items():
+            self.buckets[round(math.log2(float(bound)))] += n
+        self.count += other["count"]
+        self.total += other["total"]
+        self.max = max(self.max, other["max"])
+
+
+class StageStats:
+    def __init__(self, name: str) -> None:
+        """
+        Counters (files, lines, bytes, chars, dropped, ...) and a timing
+        histogram for one stage
+
+        """
+        self.name = name
+        self.counters = defaultdict(int)
+        self.timings = Histogram()
+
+    def add(self, **counts: int) -> None:
+        for key, value in counts.items():
+            self.counters[key] += value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings.add(time.perf_counter() - start)
+
+    def to_dict(self) -> dict:
+        return({"counters": dict(self.counters),
+                "timings": self.timings.to_dict()})
+
+    def merge(self, other: dict) -> None:
+        self.add(**other["counters"])
+        self.timings.merge(other["timings"])
+
+
+class _NullStage:
+    """
+    Stand-in returned while instrumentation is disabled
+
+    """
+    def add(self, **counts: int) -> None:
+        pass
+
+    def time(self):
+        return(nullcontext())
+
+
+_NULL_STAGE = _NullStage()
+
+
+class Stats:
+    def __init__(self) -> None:
+        """
+        Registry of StageStats. Disabled until enable() is called.
+
+        """
+        self.enabled = False
+        self.stages = {}
+        self.start = time.time()
+        self._lock = threading.Lock()
+
+    def enable(self) -> None:
+        self.enabled = True
+        self.start = time.time()
+
+    def stage(self, name: str):
+        if not self.enabled:
+            return(_NULL_STAGE)
+        stage = self.stages.get(name)
+        if stage is None:
+            with self._lock:
+                stage = self.stages.setdefault(name, StageStats(name))
+        return(stage)
+
+    def collect(self) -> Optional[dict]:
+        """
+        Returns and resets the stats gathered so far, e.g. in a worker
+        process, for merging into the parent with merge(). Returns None
+        while disabled.
+
+        """
+        if not self.enabled:
+            return(None)
+        with self._lock:
+            stages, self.stages = self.stages, {}
+        return({name: s.to_dict() for name, s in stages.items()})
+
+    def merge(self, collected: Optional[dict]) -> None:
+        if collected is None or not self.enabled:
+            return
+        for name, stage in collected.items():
+            self.stage(name).merge(stage)
+
+    def report(self) -> dict:
+        elapsed = time.time() - self.start
+        return({"elapsed": elapsed,
+                "stages": {name: s.to_dict() for name, s in
+                           list(self.stages.items())}})
+
+    def progress_line(self) -> str:
+        elapsed = time.time() - self.start
+        parts = []
+        for name, stage in list(self.stages.items()):
+            counters = ", ".join(f"{k} {v}" for k, v in
+                                 list(stage.counters.items()))
+            if "lines" in stage.counters:
+                rate = stage.counters["lines"] / max(elapsed, 1e-9)
+                counters += f" ({rate:.0f} lines/s)"
+            parts.append(f"{name}: {counters}")
+        return(f"[{elapsed:8.1f}s] " + " | ".join(parts))
+
+
+# shared instance used by all instrumented code
+STATS = Stats()
+
+
+class _StackSampler:
+    def __init__(self, interval: float = 0.01) -> None:
+        """
+        Samples the main thread's stack every interval seconds and counts
+        the innermost frames, as a low-overhead alternative to cProfile
+
+        """
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._main = threading.main_thread().ident
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._main)
+            stack = []
+            while frame is not None and len(stack) < 3:
+                code = frame.f_code
+                stack.append(f"{code.co_name} "
+                             f"({os.path.basename(code.co_filename)}:"
+                             f"{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                self.samples[" <- ".join(stack)] += 1
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def write(self, file: str) -> None:
+        total = sum(self.samples.values()) or 1
+        with open(file, "w", encoding="utf8") as f:
+            for stack, n in self.samples.most_common():
+                f.write(f"{100 * n / total:6.2f}% {n:8d}  {stack}\n")
+
+
+def add_arguments(parser: ArgumentParser) -> None:
+    """
+    Adds the --profile, --profile_mode, --progress and --stats options
+
+    """
+    parser.add_argument("--profile", type=str, default=None,
+                        help="write a profile to PROFILE.prof (or\
+                            PROFILE.samples.txt) and stats to PROFILE.json")
+    parser.add_argument("--profile_mode", type=str, default="cprofile",
+                        choices=["cprofile", "sample"],
+                        help="cProfile dump or sampled stack summary")
+    parser.add_argument("--progress", type=float, default=0,
+                        help="print a progress line to stderr every this\
+                            many seconds")
+    parser.add_argument("--stats", type=str, default=None,
+                        help="write per-stage stats as JSON to this file")
+
+
+@contextmanager
+def session(args: Namespace):
+    """
+    Enables STATS and profiling as requested by the options from
+    add_arguments, and writes the reports when the block exits
+
+    """
+    profile = getattr(args, "profile", None)
+    progress = getattr(args, "progress", 0)
+    stats_file = getattr(args, "stats", None)
+    if profile is not None and stats_file is None:
+        stats_file = f"{profile}.json"
+
+    if profile is None and not progress and stats_file is None:
+        yield
+        return
+
+    STATS.enable()
+    profiler = None
+    if profile is not None:
+        if getattr(args, "profile_mode", "cprofile") == "sample":
+            profiler = _StackSampler()
+            profiler.start()
+        else:
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+    stop = threading.Event()
+    if progress:
+        def report_progress() -> None:
+            while not stop.wait(progress):
+                print(STATS.progress_line(), file=sys.stderr, flush=True)
+        threading.Thread(target=report_progress, daemon=True).start()
+
+    try:
+        yield
+    finally:
+        stop.set()
+        if isinstance(profiler, cProfile.Profile):
+            profiler.disable()
+            profiler.dump_stats(f"{profile}.prof")
+        elif profiler is not None:
+            profiler.stop()
+            profiler.write(f"{profile}.samples.txt")
+
+        if progress:
+            print(STATS.progress_line(), file=sys.stderr, flush=True)
+        if stats_file is not None:
+            with open(stats_file, "w", encoding="utf8") as f:
+                json.dump(STATS.report(), f, indent=2)
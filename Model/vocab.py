@@ -1,15 +1,105 @@
 """
-    Module for Vocabulary class
+    Module for Vocabulary class and the CharFilter line filter
 """
 
-from typing import Iterable
-from collections import Counter
+import json, os
+import numpy as np
+
+from typing import Any, Callable, Iterable, Iterator, Optional
+from collections import Counter, deque
+from functools import cache
+from multiprocessing import Pool
 from pathlib import Path
 
+from instrumentation import STATS
+from fileio import open_text
+
 # constants
 UNK = "<UNK>"
 BOS = "<BOS>"
 EOS = "<EOS>"
+# number of characters read at a time when counting
+CHUNK_SIZE = 2**22
+# codepoints below this limit are looked up in a dense array
+DENSE_LIMIT = 2**16
+
+
+def count_chars(file: str, enc: str = "utf8",
+                chunk_size: int = CHUNK_SIZE) -> Counter:
+    """
+    Counts the non-whitespace characters of a file, which may be
+    compressed, reading it in chunks of chunk_size characters.
+
+    """
+    counts = Counter()
+    with open_text(file, encoding=enc) as f:
+        for chunk in iter(lambda: f.read(chunk_size), ""):
+            counts.update(chunk)
+    
+    for char in [c for c in counts if c.isspace()]:
+        del counts[char]
+        
+    return(counts)
+
+
+def _count_task(args: tuple) -> Counter:
+    return(count_chars(*args))
+
+
+def count_chars_in_files(files: list[str], enc: str = "utf8",
+                         workers: Optional[int] = 1,
+                         cache_file: Optional[str] = None) -> Counter:
+    """
+    Counts the non-whitespace characters of a list of files, in parallel
+    if workers > 1 (None uses all cores). Entries that are not files are
+    skipped.
+
+    If cache_file is given, per-file counts are stored there as JSON,
+    keyed by path, size and modification time, and only files that
+    changed since the last call are read again.
+
+    """
+    files = [f for f in files if Path(f).is_file()]
+    
+    cache = {}
+    if cache_file is not None and Path(cache_file).is_file():
+        with open(cache_file, encoding="utf8") as f:
+            cache = json.load(f)
+            
+    keys = {}
+    todo = []
+    for f in files:
+        stat = os.stat(f)
+        keys[f] = [stat.st_size, stat.st_mtime_ns, enc]
+        entry = cache.get(os.path.abspath(f))
+        if entry is None or entry["key"] != keys[f]:
+            todo.append(f)
+            
+    stage = STATS.stage("count_chars")
+    with stage.time():
+        if workers == 1 or len(todo) <= 1:
+            new_counts = [count_chars(f, enc) for f in todo]
+        else:
+            with Pool(workers) as pool:
+                new_counts = pool.map(_count_task, [(f, enc) for f in todo])
+    stage.add(files=len(todo), cached=len(files) - len(todo),
+              bytes=sum(keys[f][0] for f in todo))
+            
+    for f, counts in zip(todo, new_counts):
+        cache[os.path.abspath(f)] = {"key": keys[f], "counts": counts}
+        
+    if cache_file is not None and len(todo) > 0:
+        tmp_file = f"{cache_file}.tmp"
+        with open(tmp_file, "w", encoding="utf8") as f:
+            json.dump(cache, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp_file, cache_file)
+        
+    tokens = Counter()
+    for f in files:
+        tokens.update(cache[os.path.abspath(f)]["counts"])
+        
+    return(tokens)
+
 
 class Vocabulary:
     def __init__(self, tokens, 
@@ -73,25 +163,314 @@ class Vocabulary:
         """
         return([self.__getindex__(t) for t in tokens])
     
+    def _build_lookup(self) -> None:
+        """
+        Builds a dense codepoint -> index array for single-character
+        tokens, with a dict for codepoints outside the dense range, and
+        an index -> token array for decoding.
+
+        """
+        unk = self.token_to_index[UNK]
+        chars = [t for t in self.index_to_token
+                 if len(t) == 1 and t not in self.specials]
+        size = min(DENSE_LIMIT, max([ord(c) for c in chars], default=0) + 1)
+        
+        self._dense = np.full(size, unk, dtype=np.int32)
+        self._sparse = {}
+        for c in chars:
+            if ord(c) < size:
+                self._dense[ord(c)] = self.token_to_index[c]
+            else:
+                self._sparse[ord(c)] = self.token_to_index[c]
+                
+        self._index_to_token = np.array(self.index_to_token, dtype=object)
+        self._skip = np.zeros(len(self), dtype=bool)
+        for t in self.specials:
+            if t != UNK:
+                self._skip[self.token_to_index[t]] = True
+            
+    def _lookup_codepoints(self, codepoints: np.ndarray) -> np.ndarray:
+        if not hasattr(self, "_dense"):
+            self._build_lookup()
+        
+        size = len(self._dense)
+        if len(codepoints) == 0 or codepoints.max() < size:
+            return(self._dense[codepoints])
+        
+        unk = self.token_to_index[UNK]
+        dense = codepoints < size
+        indices = np.full(len(codepoints), unk, dtype=np.int32)
+        indices[dense] = self._dense[codepoints[dense]]
+        outside = np.flatnonzero(~dense)
+        indices[outside] = [self._sparse.get(int(c), unk)
+                            for c in codepoints[outside]]
+        return(indices)
+    
+    def encode(self, string: str) -> np.ndarray:
+        """
+        Maps the non-whitespace characters of a string to an int32 array of
+        indices (UNK for characters not in the vocabulary), in one
+        vectorized lookup. Equivalent to
+        tokens_to_indices(list(''.join(string.split()))).
+
+        """
+        chars = ''.join(string.split())
+        codepoints = np.frombuffer(chars.encode('utf-32-le', 'surrogatepass'),
+                                   dtype='<u4')
+        return(self._lookup_codepoints(codepoints))
+    
+    def encode_batch(self, lines: Iterable[str],
+                     return_offsets: bool = False):
+        """
+        Encodes a batch of lines with a single lookup. Returns a list of
+        index arrays, or the flat index array and an int64 array of line
+        offsets (length len(lines) + 1) if return_offsets is True.
+
+        """
+        stripped = [''.join(line.split()) for line in lines]
+        offsets = np.zeros(len(stripped) + 1, dtype=np.int64)
+        np.cumsum([len(s) for s in stripped], out=offsets[1:])
+        
+        codepoints = np.frombuffer(
+            ''.join(stripped).encode('utf-32-le', 'surrogatepass'),
+            dtype='<u4')
+        indices = self._lookup_codepoints(codepoints)
+        
+        if return_offsets:
+            return(indices, offsets)
+        if not stripped:
+            return([])
+        return(np.split(indices, offsets[1:-1]))
+    
+    def decode(self, indices, skip_specials: bool = True) -> str:
+        """
+        Maps an array of indices back to text. Special tokens other than
+        UNK are dropped if skip_specials is True (e.g. padding).
+
+        """
+        if not hasattr(self, "_dense"):
+            self._build_lookup()
+            
+        indices = np.asarray(indices, dtype=np.int64)
+        if skip_specials:
+            indices = indices[~self._skip[indices]]
+        return(''.join(self._index_to_token[indices]))
+    
+    def decode_batch(self, batch, skip_specials: bool = True) -> list[str]:
+        """
+        Decodes each row of a 2D array (e.g. a padded batch) to text.
+
+        """
+        return([self.decode(row, skip_specials) for row in np.asarray(batch)])
+    
+    def to_dict(self) -> dict:
+        """
+        Returns the index order, specials and token counts as a
+        JSON-serializable dict
+
+        """
+        return({"specials": self.specials,
+                "index_to_token": self.index_to_token,
+                "tokens": dict(self.tokens)})
+    
+    @classmethod
+    def from_dict(cls, contents: dict):
+        """
+        Rebuilds a vocabulary from the output of to_dict
+
+        """
+        vocab = cls.__new__(cls)
+        vocab.specials = contents["specials"]
+        vocab.tokens = Counter(contents["tokens"])
+        vocab.index_to_token = contents["index_to_token"]
+        vocab.token_to_index = {vocab.index_to_token[i]: i for 
+                                i in range(len(vocab.index_to_token))}
+        
+        return(vocab)
+    
+    def save(self, file: str) -> None:
+        """
+        Saves the vocabulary (index order and token counts) as compact JSON
+
+        """
+        with open(file, "w", encoding="utf8") as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False,
+                      separators=(",", ":"))
+    
+    @classmethod
+    def load(cls, file: str):
+        """
+        Loads a vocabulary written by save. Returns a Vocabulary object
+
+        """
+        with open(file, encoding="utf8") as f:
+            return(cls.from_dict(json.load(f)))
+    
     @classmethod
     def from_files(cls, files: list[str], 
-                         enc = "utf8", **kwargs):
+                         enc = "utf8", workers: Optional[int] = 1,
+                         cache_file: Optional[str] = None, **kwargs):
         """
         Builds a character-level vocabulary from a list of files.
         Returns a Vocabulary object
 
+        Files are counted in parallel if workers > 1 (None uses all
+        cores); see count_chars_in_files for cache_file.
+
         """
         
-        tokens = Counter()
-        
-        for f in files:
-            if Path(f).is_file():
-                with open(f, "r", encoding=enc) as file:
-                    lines = file.readlines()
-                    lines = [''.join(line.split()) for line in lines]
-                    
-                    for line in lines:
-                        chars = list(line)
-                        tokens.update(chars)
+        tokens = count_chars_in_files(files, enc, workers, cache_file)
                         
-        return(cls(tokens, **kwargs))
\ No newline at end of file
+        return(cls(tokens, **kwargs))
+    
+    @classmethod
+    def chars_from_files(cls, files: list[str], enc = "utf8",
+                         workers: Optional[int] = None,
+                         cache_file: Optional[str] = None, **kwargs):
+        """
+        Same as from_files, but counts files on all cores by default.
+        Returns a Vocabulary object
+
+        """
+        return(cls.from_files(files, enc, workers, cache_file, **kwargs))
+
+
+# character classes used by CharFilter
+OOV, ALLOWED, SPACE, NEWLINE = range(4)
+
+
+class CharFilter:
+    def __init__(self, chars: Iterable[str]):
+        """
+        Compiled filter that keeps lines whose non-whitespace characters
+        are all in chars. Lines are checked with newlines stripped, as in
+        clean_and_split_data.py: whitespace-only lines are rejected, but
+        empty lines are kept.
+
+        A batch of lines is checked at once: its codepoints are mapped to
+        character classes with a dense lookup table (a dict covers
+        codepoints above DENSE_LIMIT) and counted per line with prefix
+        sums, so no per-line sets or strings are built.
+
+        Parameters
+        ----------
+        chars : Iterable[str]
+            allowed characters; entries longer than one character (e.g.
+            special tokens) are ignored
+
+        """
+        self.chars = sorted(set(c for c in chars if len(c) == 1))
+        
+        self._dense = np.full(DENSE_LIMIT, OOV, dtype=np.uint8)
+        self._dense[[ord(c) for c in self.chars
+                     if ord(c) < DENSE_LIMIT]] = ALLOWED
+        self._high = np.array(sorted(ord(c) for c in self.chars
+                                     if ord(c) >= DENSE_LIMIT),
+                              dtype=np.uint32)
+        # whitespace is always allowed but does not count as content
+        self._dense[[ord(c) for c in whitespace_chars()]] = SPACE
+        self._dense[ord('\n')] = NEWLINE
+
+    @classmethod
+    def from_vocab(cls, vocab: Vocabulary):
+        return(cls(t for t in vocab.index_to_token if t not in vocab.specials))
+
+    def keep(self, line: str) -> bool:
+        return(bool(self.mask([line])[0]))
+
+    def _classes(self, text: str) -> np.ndarray:
+        codepoints = np.frombuffer(text.encode('utf-32-le', 'surrogatepass'),
+                                   dtype=np.uint32)
+        high = codepoints >= DENSE_LIMIT
+        classes = self._dense[np.where(high, 0, codepoints)]
+        if high.any():
+            classes[high] = np.where(np.isin(codepoints[high], self._high),
+                                     ALLOWED, OOV)
+        return(classes)
+
+    def mask(self, lines: list[str]) -> np.ndarray:
+        """
+        Returns a boolean array that is True for the lines to keep
+
+        """
+        lengths = np.fromiter(map(len, lines), dtype=np.int64,
+                              count=len(lines))
+        ends = np.cumsum(lengths)
+        starts = ends - lengths
+        classes = self._classes(''.join(lines))
+        
+        def per_line(c: int) -> np.ndarray:
+            counts = np.zeros(len(classes) + 1, dtype=np.int64)
+            np.cumsum(classes == c, out=counts[1:])
+            return(counts[ends] - counts[starts])
+        
+        # no OOV characters, and not whitespace-only unless empty
+        return((per_line(OOV) == 0)
+               & ((per_line(ALLOWED) > 0) | (per_line(SPACE) == 0)))
+
+    def filter(self, lines: list[str]) -> list[str]:
+        return([line for line, keep in zip(lines, self.mask(lines))
+                if keep])
+
+    def pool(self, workers: int) -> Pool:
+        """
+        Returns a process pool whose workers hold a copy of the filter,
+        for reuse across calls to mask_batches
+
+        """
+        return(Pool(workers, _init_filter, (self,)))
+
+    def mask_batches(self, batches: Iterable[Any], workers: int = 1,
+                     key: Optional[Callable[[Any], list[str]]] = None,
+                     pool: Optional[Pool] = None
+                     ) -> Iterator[tuple[Any, np.ndarray]]:
+        """
+        Yields (batch, mask) for each batch, in order. key(batch) gives
+        the lines to check (default: the batch itself). With workers > 1
+        the masks are computed in a process pool, with at most
+        2 * workers batches in flight. The pool is created for the call
+        unless one from pool() is given.
+
+        """
+        key = key if key is not None else (lambda batch: batch)
+        if workers <= 1:
+            for batch in batches:
+                yield batch, self.mask(key(batch))
+            return
+
+        if pool is None:
+            with self.pool(workers) as pool:
+                yield from self.mask_batches(batches, workers, key, pool)
+            return
+
+        pending = deque()
+        for batch in batches:
+            pending.append((batch, pool.apply_async(_mask_task,
+                                                    (key(batch),))))
+            if len(pending) >= 2 * workers:
+                batch, result = pending.popleft()
+                yield batch, result.get()
+        while pending:
+            batch, result = pending.popleft()
+            yield batch, result.get()
+
+
+# each pool worker keeps its own copy of the filter
+_worker_filter = None
+
+def _init_filter(char_filter: CharFilter) -> None:
+    global _worker_filter
+    _worker_filter = char_filter
+
+def _mask_task(lines: list[str]) -> np.ndarray:
+    return(_worker_filter.mask(lines))
+
+
+@cache
+def whitespace_chars() -> str:
+    """
+    Returns every character for which str.isspace() is True, i.e. the
+    characters that encode() drops
+
+    """
+    return(''.join(c for c in map(chr, range(0x110000)) if c.isspace()))
@@ -4,27 +4,314 @@
     Removes all lines that contain characters that appear fewer than 
     specified number of times 
     
-    Split is 80% train, 10% dev, 10% test
+    Split is 80% train, 10% dev, 10% test by default (see --ratios).
+    With --streaming, each pair is assigned to a split by a seeded hash
+    and written out immediately, so the corpus never has to fit in memory.
+    With --dedup, repeated (and with --near_dup, similar) lines are removed
+    before the splits are assigned. With --align_dir, the alignments of
+    the source files (see generate_romanization.py --align_dir) are
+    carried along and written to align_{split}.
 """
 
-import glob, re
+import glob, re, argparse, hashlib, random
 
-from sys import argv
+from contextlib import ExitStack
+from itertools import compress, islice
+from multiprocessing import Pool
 from pathlib import Path
-from random import shuffle
+from typing import Iterable, Iterator, Optional, Union
 
-from vocab import Vocabulary
+from vocab import CharFilter, Vocabulary
+from dedup import MAX_MEMORY, Deduplicator
+from instrumentation import STATS, add_arguments, session
+from fileio import IO_BUFFER, open_text
+
+# constants
+SPLITS = ("train", "dev", "test")
+# number of line pairs checked at a time
+CHUNK_LINES = 2**14
+
+# type aliases
+# (source, target) lines, optionally followed by the source's alignment
+Pair = tuple[str, ...]
+
+
+def clean_pairs(src_file: str, tgt_file: str,
+                char_filter: Union[CharFilter, Iterable[str]],
+                encoding: str = 'utf8', workers: int = 1,
+                pool: Optional[Pool] = None,
+                align_file: Optional[str] = None) -> Iterator[Pair]:
+    """
+    Yields (source, target) line pairs from two parallel files, skipping
+    whitespace-only lines and lines whose source side contains characters
+    outside the filter (see vocab.CharFilter). Pairs are read and checked
+    in chunks of CHUNK_LINES; with workers > 1 the chunks are checked in
+    a process pool, which should come from char_filter.pool() when many
+    files are cleaned. Either file may be compressed, and multi-stream bz2
+    files are decompressed by up to workers processes (see
+    fileio.open_text). If align_file is given, its lines are added to the
+    pairs as a third entry.
+
+    """
+    if not isinstance(char_filter, CharFilter):
+        char_filter = CharFilter(char_filter)
+        
+    lines = kept = 0
+    with ExitStack() as stack:
+        files = [stack.enter_context(open_text(f, encoding=encoding,
+                                               workers=workers))
+                 for f in (src_file, tgt_file, align_file) if f is not None]
+        pairs = zip(*files)
+        chunks = iter(lambda: list(islice(pairs, CHUNK_LINES)), [])
+        masks = char_filter.mask_batches(
+            chunks, workers, key=lambda chunk: [p[0] for p in chunk],
+            pool=pool)
+        
+        for chunk, mask in masks:
+            lines += len(chunk)
+            for pair, keep in zip(chunk, mask):
+                if keep:
+                    kept += 1
+                    yield tuple(line.strip('\n') for line in pair)
+                    
+    STATS.stage("clean").add(files=1, lines=lines, dropped=lines - kept)
+
+
+def dedup_pairs(pairs: Iterator[Pair], deduplicator: Deduplicator,
+                side: int = 1) -> Iterator[Pair]:
+    """
+    Yields the pairs whose side (0 = source, 1 = target) is kept by the
+    deduplicator, checking CHUNK_LINES pairs at a time. Only that side is
+    compared, and whole pairs are dropped, so pairs stay aligned.
+
+    """
+    for chunk in iter(lambda: list(islice(pairs, CHUNK_LINES)), []):
+        yield from compress(chunk, deduplicator.mask([p[side]
+                                                      for p in chunk]))
+
+
+def split_bounds(ratios: list[float]) -> list[float]:
+    """
+    Converts train/dev/test ratios into cumulative bounds on [0, 1].
+
+    """
+    if len(ratios) != len(SPLITS) or min(ratios) < 0 or sum(ratios) <= 0:
+        raise ValueError(f"Expected {len(SPLITS)} non-negative split "
+                         f"ratios, got {ratios}.")
+    
+    total = sum(ratios)
+    bounds = []
+    cumulative = 0
+    for r in ratios:
+        cumulative += r
+        bounds.append(cumulative / total)
+    return(bounds)
+
+
+def split_by_hash(text: str, bounds: list[float], seed: int = 0) -> int:
+    """
+    Assigns a string to a split (0 = train, 1 = dev, 2 = test) using a
+    seeded hash, so the assignment is reproducible and needs no global
+    shuffle.
+
+    """
+    key = f"{seed}\0{text}".encode('utf8')
+    digest = hashlib.blake2b(key, digest_size=8).digest()
+    position = int.from_bytes(digest, 'little') / 2**64
+    
+    for i, bound in enumerate(bounds):
+        if position < bound:
+            return(i)
+    return(len(bounds) - 1)
+
+
+def assign_split(pair: Pair, bounds: list[float], seed: int = 0) -> int:
+    """
+    Assigns a pair to a split by a seeded hash of its contents (see
+    split_by_hash). Identical pairs always share a split; alignments are
+    not part of the hash.
+
+    """
+    return(split_by_hash(f"{pair[0]}\0{pair[1]}", bounds, seed))
+
+
+class ShuffleBuffer:
+    
+    def __init__(self, size: int, seed: Optional[int] = None):
+        """
+        Bounded-memory approximate shuffle. Holds up to size items and,
+        once full, emits a random held item for each new one.
+
+        """
+        self.size = size
+        self.items = []
+        self.rng = random.Random(seed)
+        
+    def push(self, item) -> list:
+        """
+        Adds an item, returns the items that leave the buffer (if any).
+
+        """
+        if len(self.items) < self.size:
+            self.items.append(item)
+            return([])
+        
+        i = self.rng.randrange(self.size)
+        out, self.items[i] = self.items[i], item
+        return([out])
+    
+    def drain(self) -> list:
+        """
+        Returns all remaining items in random order.
+
+        """
+        items, self.items = self.items, []
+        self.rng.shuffle(items)
+        return(items)
+
+
+class SplitWriter:
+    
+    def __init__(self, out: str, encoding: str = 'utf8',
+                 align: bool = False):
+        """
+        Writes pairs to src_{split} and tgt_{split} files in directory
+        out, with lines separated by newlines (no trailing newline). With
+        align=True, the third entry of every pair is written to
+        align_{split}.
+
+        """
+        sides = ("src", "tgt", "align") if align else ("src", "tgt")
+        self.files = [tuple(open(f"{out}/{side}_{s}", mode='w+',
+                                 encoding=encoding, buffering=IO_BUFFER)
+                            for side in sides) for s in SPLITS]
+        self.counts = [0] * len(SPLITS)
+        
+    def write(self, split: int, pair: Pair) -> None:
+        sep = '\n' if self.counts[split] > 0 else ''
+        for file, line in zip(self.files[split], pair):
+            file.write(sep + line)
+        self.counts[split] += 1
+        
+    def close(self) -> None:
+        for files in self.files:
+            for file in files:
+                file.close()
+        STATS.stage("split").add(lines=sum(self.counts),
+                                 **dict(zip(SPLITS, self.counts)))
+            
+    def __enter__(self):
+        return(self)
+    
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def stream_split(pairs: Iterator[Pair], out: str, ratios: list[float],
+                 seed: int = 0, shuffle_buffer: int = 0,
+                 encoding: str = 'utf8', align: bool = False) -> list[int]:
+    """
+    Assigns each pair to a split by hash and writes it out as it is read.
+    If shuffle_buffer > 0, training pairs pass through a ShuffleBuffer of
+    that size. align is passed to SplitWriter. Returns the number of
+    pairs in each split.
+
+    """
+    bounds = split_bounds(ratios)
+    buffer = ShuffleBuffer(shuffle_buffer, seed) if shuffle_buffer > 0 \
+        else None
+    
+    with SplitWriter(out, encoding, align) as writer:
+        for pair in pairs:
+            split = assign_split(pair, bounds, seed)
+            if split == 0 and buffer is not None:
+                for item in buffer.push(pair):
+                    writer.write(0, item)
+            else:
+                writer.write(split, pair)
+                
+        if buffer is not None:
+            for item in buffer.drain():
+                writer.write(0, item)
+                
+    return(writer.counts)
+
+
+def shuffle_split(pairs: Iterator[Pair], out: str, ratios: list[float],
+                  seed: Optional[int] = None,
+                  encoding: str = 'utf8', align: bool = False) -> list[int]:
+    """
+    Loads all pairs into memory, shuffles them and splits them by ratio.
+    align is passed to SplitWriter. Returns the number of pairs in each
+    split.
+
+    """
+    data = list(pairs)
+    random.Random(seed).shuffle(data)
+    
+    bounds = [round(len(data) * b) for b in split_bounds(ratios)]
+    starts = [0] + bounds[:-1]
+    
+    with SplitWriter(out, encoding, align) as writer:
+        for split, (start, end) in enumerate(zip(starts, bounds)):
+            for pair in data[start:end]:
+                writer.write(split, pair)
+    
+    return(writer.counts)
 
-# regex patterns
-re_whitespace = re.compile('\s+')
 
 if __name__ == "__main__":
-    source, target, out, min_freq = argv[1:]
-    min_freq = int(min_freq)
-    # args[0] is source directory
-    # args[2] is target directory
-    # args[3] is out directory
-    # args[4] is min_freq for char vocab
+    parser = argparse.ArgumentParser()
+    parser.add_argument("source", help="source directory")
+    parser.add_argument("target", help="target directory")
+    parser.add_argument("out", help="output directory")
+    parser.add_argument("min_freq", type=int,
+                        help="minimum frequency for char vocab")
+    parser.add_argument("--ratios", type=float, nargs=3,
+                        default=[0.8, 0.1, 0.1],
+                        help="train, dev and test proportions")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="random seed for shuffling and split\
+                            assignment")
+    parser.add_argument("--streaming", action="store_true",
+                        help="assign pairs to splits by a seeded hash and\
+                            write them as they are read, without holding\
+                                the corpus in memory")
+    parser.add_argument("--shuffle_buffer", type=int, default=0,
+                        help="with --streaming, shuffle training pairs\
+                            through a buffer of this many pairs")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of processes used to count characters\
+                            and filter lines; default is all cores for\
+                                counting and one for filtering")
+    parser.add_argument("--dedup", action="store_true",
+                        help="remove pairs whose --dedup_side line was\
+                            seen before")
+    parser.add_argument("--near_dup", type=float, default=None,
+                        help="with --dedup, also remove lines whose\
+                            character 5-grams have about this Jaccard\
+                                similarity to an earlier line, e.g. 0.8")
+    parser.add_argument("--dedup_side", type=str, default="tgt",
+                        choices=["src", "tgt"],
+                        help="side compared for duplicates; default is the\
+                            target (original orthography)")
+    parser.add_argument("--dedup_memory", type=int, default=MAX_MEMORY,
+                        help="number of line fingerprints held in memory\
+                            before they are spilled to disk")
+    parser.add_argument("--dedup_dir", type=str, default=None,
+                        help="directory for spilled fingerprints; default\
+                            is the system's temporary directory")
+    parser.add_argument("--align_dir", type=str, default=None,
+                        help="directory with the alignments of the source\
+                            files (see generate_romanization.py\
+                                --align_dir); written to align_{split}")
+    parser.add_argument("--count_cache", type=str, default=None,
+                        help="JSON file caching per-file character counts,\
+                            so unchanged files are not counted again")
+    add_arguments(parser)
+    
+    args = parser.parse_args()
+    source, target, out = args.source, args.target, args.out
     
     # remove any slashes from  dir names
     target = re.sub('//', '', target)
@@ -38,66 +325,51 @@ if __name__ == "__main__":
     source_files = [f for f in source_files if Path(f).is_file()]
     
     target_files = [re.sub(source,target,f) for f in source_files]
+    align_files = [str(Path(args.align_dir, Path(f).relative_to(source)))
+                   for f in source_files] if args.align_dir is not None \
+        else [None] * len(source_files)
     
-    data = []
+    if args.near_dup is not None and not args.dedup:
+        parser.error("--near_dup requires --dedup")
     
-    vocabulary = Vocabulary.chars_from_files(source_files, min_freq=min_freq)
-    char_set = vocabulary.token_to_index.keys()
+    with session(args):
+        vocabulary = Vocabulary.chars_from_files(source_files,
+                                                 workers=args.workers,
+                                                 cache_file=args.count_cache,
+                                                 min_freq=args.min_freq)
+        char_filter = CharFilter.from_vocab(vocabulary)
+        workers = args.workers or 1
+        # one pool of filter workers for all files
+        pool = char_filter.pool(workers) if workers > 1 else None
     
-    # combine + clean data, maintaining connection between src and tgt
-    for i in range(len(source_files)):
-        src_lines = open(source_files[i], encoding='utf8').readlines()
-        tgt_lines = open(target_files[i], encoding='utf8').readlines()
-        
-        clean_src_lines = []
-        clean_tgt_lines = []
+        # combine + clean data, maintaining connection between src and tgt
+        pairs = (pair for src_file, tgt_file, align_file
+                 in zip(source_files, target_files, align_files)
+                 for pair in clean_pairs(src_file, tgt_file, char_filter,
+                                         workers=workers, pool=pool,
+                                         align_file=align_file))
         
-        for i in range(len(src_lines)):
-            line = src_lines[i].strip('\n')
-            
-            # discard empty strings
-            if re_whitespace.fullmatch(line) == None:
-                
-                # make sure line has no OOV chars
-                line_chars = ''.join(line.split())
-                line_chars = set(line_chars)
-                if len(line_chars.difference(char_set)) == 0:
-                    clean_src_lines.append(line)
-                    clean_tgt_lines.append(tgt_lines[i].strip('\n'))
-            
-        
-        data.extend(zip(clean_src_lines,clean_tgt_lines))
-        
-        
-    # shuffle data and split
-    shuffle(data)
-    first_break = round(len(data)* .8)
-    second_break = round(len(data)*.9)
-    
-    train = data[:first_break]
-    dev = data[first_break:second_break]
-    test = data[second_break:]
-    
-    # write train files
-    source_train = open(out+"/src_train", mode='w+', encoding='utf8')
-    source_train.write('\n'.join([line[0] for line in train]))
-    source_train.close()
-    target_train = open(out+"/tgt_train", mode='w+', encoding='utf8')
-    target_train.write('\n'.join([line[1] for line in train]))
-    target_train.close()
-    
-   # write dev files
-    source_dev = open(out+"/src_dev",mode='w+', encoding='utf8')
-    source_dev.write('\n'.join([line[0] for line in dev]))
-    source_dev.close()
-    target_dev = open(out+"/tgt_dev",mode='w+', encoding='utf8')
-    target_dev.write('\n'.join([line[1] for line in dev]))
-    target_dev.close()
-    
-    # write test files
-    source_test = open(out+"/src_test",mode='w+', encoding='utf8')
-    source_test.write('\n'.join([line[0] for line in test]))
-    source_test.close()
-    target_test = open(out+"/tgt_test",mode='w+', encoding='utf8')
-    target_test.write('\n'.join([line[1] for line in test]))
-    target_test.close()
\ No newline at end of file
+        # remove duplicates before splitting, so none cross splits
+        deduplicator = None
+        if args.dedup:
+            deduplicator = Deduplicator(args.near_dup,
+                                        max_memory=args.dedup_memory,
+                                        tmp_dir=args.dedup_dir)
+            pairs = dedup_pairs(pairs, deduplicator,
+                                side=("src", "tgt").index(args.dedup_side))
+    
+        try:
+            if args.streaming:
+                seed = args.seed if args.seed is not None else 0
+                stream_split(pairs, out, args.ratios, seed,
+                             args.shuffle_buffer,
+                             align=args.align_dir is not None)
+            else:
+                shuffle_split(pairs, out, args.ratios, args.seed,
+                              align=args.align_dir is not None)
+        finally:
+            if deduplicator is not None:
+                deduplicator.close()
+            if pool is not None:
+                pool.close()
+                pool.join()
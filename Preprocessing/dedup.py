@@ -0,0 +1,278 @@
+"""
+    Module for removing exact and near-duplicate lines from a stream of
+    line batches, as used by clean_and_split_data.py.
+
+    Exact duplicates are found with 64-bit fingerprints of the lines,
+    kept in a FingerprintSet that spills sorted runs to disk once it
+    holds a given number of fingerprints. Near-duplicates are found with
+    MinHash signatures over character n-grams and locality-sensitive
+    hashing (LSH): a line is dropped if any band of its signature was
+    seen before. The band keys are kept in a FingerprintSet as well.
+"""
+
+import hashlib, os, tempfile
+import numpy as np
+
+from typing import Optional
+
+from instrumentation import STATS
+
+# constants
+# number of fingerprints held in memory before they are spilled to disk
+MAX_MEMORY = 2**25
+# maximum number of hash functions in a MinHash signature
+NUM_PERM = 128
+# length of the character n-grams compared for near-duplicates
+NGRAM = 5
+# odd multipliers for polynomial hashing of codepoints and band values
+MULTIPLIER = np.uint64(0x100000001B3)
+BAND_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+
+def fingerprints(lines: list[str]) -> np.ndarray:
+    """
+    Returns a 64-bit blake2b fingerprint of every line. With n distinct
+    lines, a false match has a probability of about n**2 / 2**65.
+
+    """
+    return(np.fromiter(
+        (int.from_bytes(hashlib.blake2b(line.encode('utf8'),
+                                        digest_size=8).digest(), 'little')
+         for line in lines), dtype=np.uint64, count=len(lines)))
+
+
+def _mix(values: np.ndarray) -> np.ndarray:
+    # splitmix64 finalizer; spreads polynomial hashes over all 64 bits
+    values = values ^ (values >> np.uint64(30))
+    values = values * np.uint64(0xBF58476D1CE4E5B9)
+    values = values ^ (values >> np.uint64(27))
+    values = values * np.uint64(0x94D049BB133111EB)
+    return(values ^ (values >> np.uint64(31)))
+
+
+def lsh_params(threshold: float, num_perm: int = NUM_PERM) -> tuple[int, int]:
+    """
+    Returns (bands, rows) with bands * rows <= num_perm whose LSH
+    threshold (1 / bands) ** (1 / rows) is closest to the given Jaccard
+    similarity
+
+    """
+    if not 0 < threshold < 1:
+        raise ValueError(f"Expected a threshold between 0 and 1, got "
+                         f"{threshold}.")
+    options = [(abs((1 / b) ** (1 / r) - threshold), -b * r, b, r)
+               for b in range(1, num_perm + 1)
+               for r in range(1, num_perm // b + 1)]
+    _, _, bands, rows = min(options)
+    return(bands, rows)
+
+
+class FingerprintSet:
+    def __init__(self, max_memory: int = MAX_MEMORY,
+                 tmp_dir: Optional[str] = None) -> None:
+        """
+        Set of 64-bit fingerprints held as sorted runs. New fingerprints
+        form a run that is merged with the previous one while they are of
+        similar size, so a batch is checked against few runs. Once
+        max_memory fingerprints are held, the runs are merged and written
+        to a temporary .npy file, which is memory-mapped for lookups.
+
+        Parameters
+        ----------
+        max_memory : int, optional
+            number of fingerprints held in memory
+        tmp_dir : str, optional
+            directory for the spilled runs; default is the system's
+            temporary directory
+
+        """
+        self.max_memory = max_memory
+        self.tmp_dir = tmp_dir
+        self.size = 0
+        self._runs = []
+        self._disk = []
+        self._dir = None
+
+    def __len__(self) -> int:
+        return(self.size)
+
+    def contains(self, values: np.ndarray) -> np.ndarray:
+        found = np.zeros(len(values), dtype=bool)
+        for run in self._disk + self._runs:
+            i = np.minimum(np.searchsorted(run, values), len(run) - 1)
+            found |= run[i] == values
+        return(found)
+
+    def add(self, values: np.ndarray) -> None:
+        values = np.unique(values)
+        run = values[~self.contains(values)]
+        if len(run) == 0:
+            return
+        self._runs.append(run)
+        self.size += len(run)
+
+        # runs are disjoint, so merging is a sort of their concatenation
+        while len(self._runs) > 1 \
+            and len(self._runs[-2]) <= 2 * len(self._runs[-1]):
+            merged = np.concatenate(self._runs[-2:])
+            merged.sort()
+            self._runs[-2:] = [merged]
+
+        if sum(len(r) for r in self._runs) >= self.max_memory:
+            self._spill()
+
+    def _spill(self) -> None:
+        run = np.concatenate(self._runs)
+        run.sort()
+        if self._dir is None:
+            self._dir = tempfile.TemporaryDirectory(prefix="dedup",
+                                                    dir=self.tmp_dir)
+        file = os.path.join(self._dir.name, f"run{len(self._disk):05d}.npy")
+        np.save(file, run)
+        self._disk.append(np.load(file, mmap_mode='r'))
+        self._runs = []
+
+    def close(self) -> None:
+        self._runs = []
+        self._disk = []
+        if self._dir is not None:
+            self._dir.cleanup()
+            self._dir = None
+
+
+class MinHasher:
+    def __init__(self, threshold: float = 0.8, ngram: int = NGRAM,
+                 num_perm: int = NUM_PERM, seed: int = 0) -> None:
+        """
+        Computes LSH band keys from MinHash signatures over the character
+        n-grams of lines. Two lines whose n-gram sets have a Jaccard
+        similarity around threshold share at least one band key with
+        probability 1/2; more similar lines almost always do.
+
+        """
+        self.ngram = ngram
+        self.bands, self.rows = lsh_params(threshold, num_perm)
+        rng = np.random.default_rng(seed)
+        size = self.bands * self.rows
+        self._a = rng.integers(0, 2**63, size, dtype=np.uint64) \
+            * np.uint64(2) + np.uint64(1)
+        self._b = rng.integers(0, 2**63, size, dtype=np.uint64)
+
+    def band_keys(self, lines: list[str]) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the band keys of the lines that have at least one
+        n-gram, as an array of shape (lines, bands), and the indices of
+        those lines
+
+        """
+        lengths = np.fromiter(map(len, lines), dtype=np.int64,
+                              count=len(lines))
+        text = ''.join(lines).encode('utf-32-le', 'surrogatepass')
+        codepoints = np.frombuffer(text, dtype=np.uint32).astype(np.uint64)
+
+        # hash of the n-gram starting at every position
+        positions = len(codepoints) - self.ngram + 1
+        hashes = np.zeros(max(positions, 0), dtype=np.uint64)
+        for j in range(self.ngram):
+            hashes = hashes * MULTIPLIER + codepoints[j:j + len(hashes)]
+        hashes = _mix(hashes)
+
+        # keep the n-grams that lie within a single line
+        counts = np.maximum(lengths - self.ngram + 1, 0)
+        line_ids = np.flatnonzero(counts)
+        starts = (np.cumsum(lengths) - lengths)[line_ids]
+        counts = counts[line_ids]
+        offsets = np.cumsum(counts) - counts
+        hashes = hashes[np.repeat(starts - offsets, counts)
+                        + np.arange(counts.sum())]
+
+        # signature: minimum of each permutation over a line's n-grams
+        signatures = np.empty((len(line_ids), len(self._a)), dtype=np.uint64)
+        if len(line_ids) > 0:
+            for p in range(len(self._a)):
+                signatures[:, p] = np.minimum.reduceat(
+                    hashes * self._a[p] + self._b[p], offsets)
+
+        # one key per band, which also depends on the band's index
+        bands = signatures.reshape(len(line_ids), self.bands, self.rows)
+        keys = np.broadcast_to(np.arange(self.bands, dtype=np.uint64),
+                               bands.shape[:2]).copy()
+        for r in range(self.rows):
+            keys = keys * BAND_MULTIPLIER + bands[:, :, r]
+        return(_mix(keys), line_ids)
+
+
+class Deduplicator:
+    def __init__(self, near_threshold: Optional[float] = None,
+                 ngram: int = NGRAM, max_memory: int = MAX_MEMORY,
+                 tmp_dir: Optional[str] = None) -> None:
+        """
+        Decides which lines of a stream of batches to keep: the first
+        occurrence of every line and, if near_threshold is given, only
+        lines that do not share an LSH band with an earlier line (see
+        MinHasher). Band keys of all lines are remembered, including
+        dropped ones, so a chain of similar lines keeps only its first.
+        Lines shorter than ngram characters are only checked for exact
+        duplicates.
+
+        Parameters
+        ----------
+        near_threshold : float, optional
+            Jaccard similarity of character n-grams above which lines
+            count as near-duplicates; None only removes exact duplicates
+        ngram : int, optional
+            n-gram length for near-duplicates
+        max_memory, tmp_dir : optional
+            see FingerprintSet; each set holds up to max_memory values
+
+        """
+        self.exact = FingerprintSet(max_memory, tmp_dir)
+        self.hasher = None
+        self.near = None
+        if near_threshold is not None:
+            self.hasher = MinHasher(near_threshold, ngram)
+            self.near = FingerprintSet(max_memory, tmp_dir)
+
+    def mask(self, lines: list[str]) -> np.ndarray:
+        """
+        Returns a boolean array that is True for the lines to keep, and
+        remembers the lines for later batches
+
+        """
+        stage = STATS.stage("dedup")
+        with stage.time():
+            values = fingerprints(lines)
+            _, first = np.unique(values, return_index=True)
+            keep = np.zeros(len(lines), dtype=bool)
+            keep[first] = True
+            keep &= ~self.exact.contains(values)
+            self.exact.add(values)
+            exact = len(lines) - int(keep.sum())
+
+            if self.hasher is not None:
+                keys, line_ids = self.hasher.band_keys(lines)
+                flat = keys.ravel()
+                owners = np.repeat(line_ids, keys.shape[1])
+                # a key is old if an earlier batch or line had it
+                unique, first, inverse = np.unique(flat, return_index=True,
+                                                   return_inverse=True)
+                old = self.near.contains(unique)[inverse] \
+                    | (owners[first][inverse] < owners)
+                similar = old.reshape(keys.shape).any(axis=1)
+                keep[line_ids[similar]] = False
+                self.near.add(unique)
+
+        stage.add(lines=len(lines), exact=exact,
+                  near=len(lines) - exact - int(keep.sum()))
+        return(keep)
+
+    def close(self) -> None:
+        self.exact.close()
+        if self.near is not None:
+            self.near.close()
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, *exc) -> None:
+        self.close()
@@ -4,9 +4,20 @@
     
 """
 
-import re, random, argparse, glob
+import re, random, argparse, glob, hashlib, heapq, io, math, os, shutil
 import numpy as np
+from multiprocessing import Pool
+from functools import lru_cache
+from itertools import accumulate, chain
 from pathlib import Path
+from typing import Iterable, Iterator, Optional, Union
+
+from instrumentation import STATS, add_arguments, session
+from manifest import (Manifest, atomic_output, combine_hashes, file_hash,
+                      new_hash, temp_path)
+from fileio import (COMPRESSED, IO_BUFFER, compression, iter_line_range,
+                    open_text, with_compression)
+from alignment import Alignment, format_alignment
 
 # constants
 NULL = "<null>"
@@ -18,11 +29,15 @@ trans_prob = tuple[list[str], list[float]]
 # regex utilities
 re_char_file = re.compile(r"(.*) --- (.*);\s*(.*)?")
 re_comment_line = re.compile(r"^#")
+re_word = re.compile(r"\s+|\S+")
+
+# approximate number of characters romanized per romanize_batch call
+BATCH_CHARS = 2**20
 
 class Romanizer:
     
     def __init__(self, char_probs: dict[str, trans_prob],
-                 encoding: str = 'utf8'):
+                 encoding: str = 'utf8', cache_size: int = 2**16):
         """
         Object for generating artificially Romanized text using 
         handwritten transliteration rules and probabilities
@@ -36,6 +51,9 @@ class Romanizer:
             where probabilities are cumulative
         encoding : str, optional
             default is 'utf8'.
+        cache_size : int, optional
+            number of words whose segmentation is cached; None means
+            unbounded. default is 65536
 
         """
         self.char_probs = char_probs
@@ -75,8 +93,41 @@ class Romanizer:
                 
                 if i == len(lc) - 1:
                     curr[END] = lc
-                
-        
+
+        self.cache_size = cache_size
+        self._build_segmenter()
+        self._compile_tables()
+        # ranked candidates per character, see ranked_candidates
+        self._ranked = {}
+
+    def _compile_tables(self) -> None:
+        """
+        Flattens char_probs into NumPy lookup tables for batch romanization.
+
+        Every character in char_probs gets an integer id. The cumulative
+        weights of character i are normalized to (0, 1] and shifted by i, so
+        the weights of all characters form one increasing array and a single
+        searchsorted call picks candidates for any mix of characters.
+
+        """
+        self.char_index = {}
+        candidates = []
+        cum_weights = []
+
+        for i, (char, (cands, probs)) in enumerate(self.char_probs.items()):
+            self.char_index[char] = i
+            total = probs[-1]
+            candidates.extend(['' if c == NULL else c for c in cands])
+            cum_weights.extend([i + p / total for p in probs])
+
+        self.cand_table = np.array(candidates, dtype=object)
+        self.cum_table = np.array(cum_weights, dtype=np.float64)
+
+        # index of the last candidate of each character, used to guard
+        # against float rounding pushing a draw into the next character
+        counts = [len(self.char_probs[c][0]) for c in self.char_index]
+        self.cand_end = np.cumsum(counts, dtype=np.int64) - 1
+
     def get_trans_char(self, char: str) -> str:
         if char == NULL:
             return('')
@@ -95,64 +146,425 @@ class Romanizer:
     def segment_str(self, string: str) -> list:
         """
         Converts string to a list, treating all the items in long_chars
-        as single characters.
+        as single characters. Always picks the longest matching item.
+
+        Words (and runs of whitespace) are segmented independently and
+        their segmentations are kept in an LRU cache; see segment_cache_info.
 
         """
-        segments = []
+        if self._split_words:
+            segments = []
+            for word in re_word.findall(string):
+                segments.extend(self._segment_word(word))
+            return(segments)
         
-        i = 0
-        while i < len(string):
-            if string[i] not in self.long_chars:
-                segments.append(string[i])
-                i += 1
-             
-            # accounts for multi-char "characters"
-            else:
-                candidates = []
-                curr = self.long_chars[string[i]]
-                j = i + 1
-                while j < len(string) and string[j] in curr:
-                    curr = curr[string[j]]
-                    j += 1
-                    if END in curr:
-                        candidates.append(curr[END])
-                        
-                if len(candidates) == 0:
-                    segments.append(string[i])
-                    i += 1
-                    
-                else:
-                    segments.append(candidates.pop())
-                    i += len(segments[-1])
-                    
-                    
-        return(segments)
-                        
+        return(list(self._segment_word(string)))
+
+    def _segment_word_uncached(self, word: str) -> tuple:
+        return(tuple(self._re_segment.findall(word)))
+
+    def _build_segmenter(self) -> None:
+        """
+        Compiles long_chars into a single regex alternation, ordered
+        longest-first so that the longest match wins, and sets up the
+        segmentation cache.
+
+        """
+        long_chars = sorted((c for c in self.char_probs if len(c) > 1),
+                            key=len, reverse=True)
+        self._re_segment = re.compile(
+            ''.join(re.escape(c) + '|' for c in long_chars) + '.', re.DOTALL)
+        
+        # splitting on whitespace is only safe if no long char mixes
+        # whitespace and other characters
+        self._split_words = not any(
+            re.search(r'\s', c) and re.search(r'\S', c) for c in long_chars)
+        
+        self._segment_word = lru_cache(maxsize=self.cache_size)(
+            self._segment_word_uncached)
+
+    def segment_cache_info(self):
+        """
+        Returns hits, misses, maxsize and currsize of the segmentation cache.
+
+        """
+        return(self._segment_word.cache_info())
+
+    def clear_segment_cache(self) -> None:
+        self._segment_word.cache_clear()
+
+    def __getstate__(self) -> dict:
+        # the cache wraps a bound method and is rebuilt after unpickling
+        state = self.__dict__.copy()
+        del state['_segment_word']
+        return(state)
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._segment_word = lru_cache(maxsize=self.cache_size)(
+            self._segment_word_uncached)
                 
     
-    def get_trans_str(self, string: str) -> str:
+    def get_trans_str(self, string: str, align: bool = False
+                      ) -> Union[str, tuple[str, Alignment]]:
+        """
+        Romanizes a string. With align=True, also returns its Alignment
+        (see alignment.py): an int64 array with one row per segment
+        boundary (see segment_str), holding the offsets in string and in
+        the result.
+
+        """
         result = ""
         
         sequence = self.segment_str(string)
         
+        if align:
+            parts = [self.get_trans_char(char) for char in sequence]
+            alignment = np.array(
+                list(zip(accumulate(map(len, sequence), initial=0),
+                         accumulate(map(len, parts), initial=0))),
+                dtype=np.int64)
+            return(''.join(parts), alignment)
+        
         for char in sequence:
             result += self.get_trans_char(char)
             
         return(result)
+
+    def romanize_batch(self, lines: Iterable[str],
+                       seed: Union[int, np.random.Generator,
+                                   list[np.random.Generator], None] = None,
+                       align: bool = False
+                       ) -> Union[list[str], tuple[list[str],
+                                                   list[Alignment]]]:
+        """
+        Romanizes a batch of strings at once. Draws from the same
+        distribution as get_trans_str, but makes a single random draw
+        and a single table lookup for the whole batch.
+
+        Parameters
+        ----------
+        lines : Iterable[str]
+            strings in original orthography
+        seed : int or numpy.random.Generator, optional
+            seed or generator used for sampling; passing the same seed
+            reproduces the same output. A list holds one generator per
+            string, so strings batched together from several sources
+            (see romanization_server.py) get the same draws as if each
+            source had been romanized on its own
+        align : bool, optional
+            also return the Alignment of every string (see
+            get_trans_str)
+
+        """
+        rng = seed if isinstance(seed, list) else np.random.default_rng(seed)
+        segments = [self.segment_str(line) for line in lines]
+
+        return(self._romanize_segments(segments, rng, align))
+
+    def _romanize_segments(self, segments: list[list[str]],
+                           rng: Union[np.random.Generator,
+                                      list[np.random.Generator]],
+                           align: bool = False
+                           ) -> Union[list[str], tuple[list[str],
+                                                       list[Alignment]]]:
+        """
+        Romanizes already segmented strings using the compiled tables.
+
+        """
+        lengths = [len(s) for s in segments]
+        flat = list(chain.from_iterable(segments))
+        
+        # characters without a key entry are copied through unchanged
+        ids = np.fromiter((self.char_index.get(c, -1) for c in flat),
+                          dtype=np.int64, count=len(flat))
+        mapped = np.flatnonzero(ids >= 0)
+        ids = ids[mapped]
+
+        if isinstance(rng, list):
+            # each string draws from its own generator, in order
+            counts = np.bincount(np.repeat(np.arange(len(lengths)),
+                                           lengths)[mapped],
+                                 minlength=len(lengths))
+            draws = np.concatenate([np.zeros(0)] + [
+                g.random(c) for g, c in zip(rng, counts.tolist())])
+        else:
+            draws = rng.random(len(ids))
+        picks = np.searchsorted(self.cum_table, ids + draws, side='right')
+        picks = np.minimum(picks, self.cand_end[ids])
+
+        pieces = np.array(flat, dtype=object)
+        pieces[mapped] = self.cand_table[picks]
+        pieces = pieces.tolist()
+
+        results = []
+        start = 0
+        for length in lengths:
+            results.append(''.join(pieces[start:start + length]))
+            start += length
+
+        if not align:
+            return(results)
+        
+        # cumulative segment lengths on both sides, restarting every line
+        sizes = np.zeros((len(flat), 2), dtype=np.int64)
+        sizes[:, 0] = np.fromiter(map(len, flat), dtype=np.int64,
+                                  count=len(flat))
+        sizes[:, 1] = np.fromiter(map(len, pieces), dtype=np.int64,
+                                  count=len(flat))
+        ends = np.cumsum(sizes, axis=0)
+        alignments = []
+        start = 0
+        for length in lengths:
+            alignment = np.zeros((length + 1, 2), dtype=np.int64)
+            if length > 0:
+                alignment[1:] = ends[start:start + length] \
+                    - (ends[start - 1] if start > 0 else 0)
+            alignments.append(alignment)
+            start += length
+            
+        return(results, alignments)
+    
+    def romanize_file(self, in_file: str, out_file: Union[str, list[str]],
+                      samples: int = 1, interleave: bool = False,
+                      seed: Union[int, np.random.Generator, None] = None,
+                      chunk_size: int = BATCH_CHARS,
+                      align_file: Union[str, list[str], None] = None
+                      ) -> None:
+        """
+        Romanizes a file, reading and writing it in buffered chunks of
+        about chunk_size characters so memory use does not depend on the
+        size of the file. Input and output files may be compressed (see
+        fileio.open_text).
+
+        Parameters
+        ----------
+        in_file : str
+            file in original orthography
+        out_file : str or list[str]
+            output file, or one output file per sample; if a single name
+            is given for several non-interleaved samples, sample k is
+            written to out_file.k
+        samples : int, optional
+            number of independent romanizations of each line; each line
+            is read and segmented only once. default is 1
+        interleave : bool, optional
+            write all samples of a line consecutively to a single file
+            instead of to one file per sample. default is False
+        seed : int or numpy.random.Generator, optional
+            seed or generator used for sampling
+        chunk_size : int, optional
+            approximate number of characters processed at a time
+        align_file : str or list[str], optional
+            file(s) for the alignment of every output line (see
+            alignment.py), named like out_file
+
+        """
+        def per_sample(file: Union[str, list[str]]) -> list[str]:
+            count = 1 if interleave else samples
+            if isinstance(file, str):
+                if count == 1:
+                    return([file])
+                ext = compression(file)
+                return([with_compression(file, "") + f".{k}{ext}"
+                        for k in range(samples)])
+            if len(file) != count:
+                raise ValueError(
+                    f"Expected {count} output files, got {len(file)}.")
+            return(list(file))
+        
+        out_files = per_sample(out_file)
+        align_files = per_sample(align_file) if align_file is not None \
+            else None
+
+        with open_text(in_file, encoding=self.encoding) as file:
+            chunks = iter(lambda: file.readlines(chunk_size), [])
+            self.romanize_chunks(chunks, out_files, samples, interleave,
+                                 seed, align_files)
+        STATS.stage("romanize").add(files=1,
+                                    bytes=os.path.getsize(in_file))
+
+    def romanize_chunks(self, chunks: Iterable[list[str]],
+                        out_files: list[str], samples: int = 1,
+                        interleave: bool = False,
+                        seed: Union[int, np.random.Generator, None] = None,
+                        align_files: Optional[list[str]] = None) -> None:
+        """
+        Romanizes an iterable of line chunks and writes one write call
+        per chunk and output file. See romanize_file for the parameters;
+        align_files has one alignment file per output file.
+
+        """
+        if not interleave and len(out_files) != samples:
+            raise ValueError(
+                f"Expected {samples} output files, got {len(out_files)}.")
+
+        rng = np.random.default_rng(seed)
+        files = [open_text(f, mode="w", encoding=self.encoding)
+                 for f in out_files]
+        align = align_files is not None
+        align_files = [open_text(f, mode="w") for f in align_files] \
+            if align else []
+        stage = STATS.stage("romanize")
+        
+        try:
+            for chunk in chunks:
+                stage.add(lines=len(chunk), chars=sum(map(len, chunk)))
+                with stage.time():
+                    segments = [self.segment_str(line) for line in chunk]
+                    results = [self._romanize_segments(segments, rng, align)
+                               for _ in range(samples)]
+                    if align:
+                        results, alignments = zip(*results)
+                        alignments = [[format_alignment(a) for a in sample]
+                                      for sample in alignments]
+                
+                if interleave:
+                    # make sure the variants of a line stay on separate lines
+                    results = [[line if line.endswith('\n') else line + '\n'
+                                for line in result] for result in results]
+                    files[0].write(''.join(chain.from_iterable(
+                        zip(*results))))
+                    if align:
+                        align_files[0].write(''.join(chain.from_iterable(
+                            zip(*alignments))))
+                else:
+                    for file, result in zip(files, results):
+                        file.write(''.join(result))
+                    for file, sample in zip(align_files, alignments
+                                            if align else []):
+                        file.write(''.join(sample))
+        finally:
+            for file in files + align_files:
+                file.close()
     
-    def romanize_file(self, in_file: str, out_file: str) -> None:
-        orig_lines = open(in_file, encoding=self.encoding).readlines()
+    def ranked_candidates(self, char: str) -> list[tuple[str, float]]:
+        """
+        Returns the Romanization candidates of a (possibly long) character
+        with their log probabilities, most probable first. Probabilities
+        are the differences of the cumulative weights in char_probs;
+        candidates listed more than once are merged and candidates with
+        zero weight are left out. Characters without a key entry only
+        map to themselves.
+
+        """
+        ranked = self._ranked.get(char)
+        if ranked is not None:
+            return(ranked)
+        
+        if char not in self.char_probs:
+            ranked = [(char, 0.0)]
+        else:
+            cands, probs = self.char_probs[char]
+            weights = {}
+            previous = 0
+            for cand, prob in zip(cands, probs):
+                cand = '' if cand == NULL else cand
+                weights[cand] = weights.get(cand, 0) + prob - previous
+                previous = prob
+            ranked = sorted(((c, math.log(w / previous))
+                             for c, w in weights.items() if w > 0),
+                            key=lambda item: -item[1])
+            
+        self._ranked[char] = ranked
+        return(ranked)
+
+    def count_romanizations(self, string: str) -> int:
+        """
+        Returns the number of candidate combinations for string, i.e. the
+        number of items enumerate_romanizations yields with unique=False,
+        without enumerating them
+
+        """
+        return(math.prod(len(self.ranked_candidates(c))
+                         for c in self.segment_str(string)))
+
+    def enumerate_romanizations(self, string: str,
+                                top_k: Optional[int] = None,
+                                unique: bool = False
+                                ) -> Iterator[tuple[str, float]]:
+        """
+        Lazily yields (romanization, log probability) pairs for string in
+        order of descending probability.
+
+        Characters with more than one candidate are sorted by the ratio
+        of their second to their first candidate probability. Each
+        combination is reached from exactly one earlier one by raising
+        the candidate of the last changed character, changing the next
+        character, or moving a first change on to the next character, so
+        every step pushes at most three combinations onto the heap and
+        memory grows with the number of items yielded, not with the
+        number of combinations.
+
+        Parameters
+        ----------
+        string : str
+            string in original orthography
+        top_k : int, optional
+            stop after this many items. default is no limit
+        unique : bool, optional
+            skip romanizations already yielded for another combination
+            (e.g. through null candidates); the log probability is that
+            of the most probable combination. default is False
+
+        """
+        segments = self.segment_str(string)
+        ranked = [self.ranked_candidates(c) for c in segments]
+        
+        # characters with a choice, most probable first change first
+        positions = sorted(
+            (i for i, cands in enumerate(ranked) if len(cands) > 1),
+            key=lambda i: ranked[i][0][1] - ranked[i][1][1])
+        
+        best = [cands[0][0] for cands in ranked]
+        best_logp = sum(cands[0][1] for cands in ranked)
         
-        with open(out_file, mode="w+", encoding=self.encoding) as file:
-            for line in orig_lines:
-                file.write(self.get_trans_str(line))
+        def change(logp: float, choice: list, j: int, k: int) -> float:
+            # sets position j to candidate k, returns the new log prob
+            cands = ranked[positions[j]]
+            logp += cands[k][1] - cands[choice[j]][1]
+            choice[j] = k
+            return(logp)
+        
+        heap = [(-best_logp, (0,) * len(positions), -1)]
+        seen = set()
+        yielded = 0
+        while heap and (top_k is None or yielded < top_k):
+            neg_logp, choice, last = heapq.heappop(heap)
+            
+            pieces = list(best)
+            for j, k in enumerate(choice):
+                if k > 0:
+                    pieces[positions[j]] = ranked[positions[j]][k][0]
+            result = ''.join(pieces)
+            
+            if not unique or result not in seen:
+                if unique:
+                    seen.add(result)
+                yielded += 1
+                yield (result, -neg_logp)
+                
+            # successors; last is the last position with a non-first
+            # candidate, or -1 for the most probable combination
+            nxt = last + 1
+            logp = -neg_logp
+            if last >= 0 and choice[last] + 1 < len(
+                    ranked[positions[last]]):
+                raised = list(choice)
+                raised_logp = change(logp, raised, last, choice[last] + 1)
+                heapq.heappush(heap, (-raised_logp, tuple(raised), last))
+            if nxt < len(positions):
+                changed = list(choice)
+                changed_logp = change(logp, changed, nxt, 1)
+                heapq.heappush(heap, (-changed_logp, tuple(changed), nxt))
+                if last >= 0 and choice[last] == 1:
+                    changed_logp = change(changed_logp, changed, last, 0)
+                    heapq.heappush(heap, (-changed_logp, tuple(changed),
+                                          nxt))
     
-    # TODO: add any_possible option
     @classmethod
     def from_file(cls, rom_file: str, prop_typical: float = 0.9,
-                  encoding: str = 'utf8',
-                  # any_possible: bool = False
-                  ):
+                  encoding: str = 'utf8', cache_size: int = 2**16):
         """
         Creates a Romanizer object from a .txt file containing
         a Romanization key
@@ -163,6 +575,8 @@ class Romanizer:
                 see hye_translit_key for formatting
         prop_typical: float, amount of probability weight assigned to more
                 probable transliterations; default 0.9
+        cache_size: int, number of words whose segmentation is cached;
+                default 65536
 
         """
         lines = open(rom_file, encoding=encoding).readlines()
@@ -203,10 +617,121 @@ class Romanizer:
                     # add character and candidate transliterations to table    
                     char_probs[orig] = tuple([chars, probs])
                     
-        return(Romanizer(char_probs, encoding=encoding))
+        return(Romanizer(char_probs, encoding=encoding,
+                         cache_size=cache_size))
                         
                     
     
+def shard_seed(seed: int, rel_path: str, index: int) -> int:
+    """
+    Derives the RNG seed for one shard (byte range) of one input file
+    from the global seed, the file's path relative to the input
+    directory and the shard index. Seeds do not depend on the number of
+    workers, so output is identical for any --workers value.
+
+    """
+    key = f"{seed}\0{rel_path}\0{index}".encode('utf8')
+    digest = hashlib.blake2b(key, digest_size=8).digest()
+    return(int.from_bytes(digest, 'little'))
+
+
+def plan_shards(file: str, chunk_size: int) -> list[tuple[int, int]]:
+    """
+    Splits a file into byte ranges of roughly chunk_size bytes, each
+    ending on a line boundary. Always returns at least one range.
+    Compressed files cannot be split and are returned as a single range.
+
+    """
+    size = os.path.getsize(file)
+    if compression(file):
+        return([(0, size)])
+    bounds = [0]
+
+    with open(file, 'rb') as f:
+        while bounds[-1] + chunk_size < size:
+            f.seek(bounds[-1] + chunk_size)
+            f.readline()
+            if f.tell() >= size:
+                break
+            bounds.append(f.tell())
+
+    bounds.append(size)
+    return(list(zip(bounds[:-1], bounds[1:])))
+
+
+def iter_range_chunks(in_file: str, start: int, end: int,
+                      encoding: str = 'utf8',
+                      chunk_size: int = BATCH_CHARS, digest=None):
+    """
+    Yields lists of lines from bytes [start, end) of in_file, about
+    chunk_size bytes at a time. Newlines are translated as in text mode.
+    The encoding must keep newlines as single bytes (e.g. utf8). If a
+    hash object is given as digest, it is updated with the bytes read.
+
+    A compressed file is always read as a whole, as its single range from
+    plan_shards.
+
+    """
+    if compression(in_file):
+        with open_text(in_file, encoding=encoding, digest=digest) as f:
+            yield from iter(lambda: f.readlines(chunk_size), [])
+        return
+
+    for chunk in iter_line_range(in_file, start, end, chunk_size):
+        data = b''.join(chunk)
+        if digest is not None:
+            digest.update(data)
+        yield io.TextIOWrapper(io.BytesIO(data), encoding=encoding
+                               ).readlines()
+
+
+def romanize_shard(romanizer: Romanizer, in_file: str,
+                   out_files: list[str], start: int, end: int, seed: int,
+                   samples: int = 1, interleave: bool = False,
+                   align_files: Optional[list[str]] = None,
+                   digest=None) -> None:
+    """
+    Romanizes the lines in bytes [start, end) of in_file and writes them
+    to out_files, and their alignments to align_files if given.
+    Rerunning with the same seed regenerates the same output, so a single
+    failed shard can be redone on its own. digest is passed to
+    iter_range_chunks.
+
+    """
+    chunks = iter_range_chunks(in_file, start, end, romanizer.encoding,
+                               digest=digest)
+    romanizer.romanize_chunks(chunks, out_files, samples, interleave, seed,
+                              align_files)
+    STATS.stage("romanize").add(shards=1, bytes=end - start)
+
+
+# each pool worker builds its own Romanizer once
+_worker_romanizer = None
+
+_worker_options = {}
+# whether shards are hashed while they are read, for the manifest
+_worker_hashed = False
+
+def _init_worker(key: str, prop_typical: float, encoding: str,
+                 samples: int = 1, interleave: bool = False,
+                 hashed: bool = False) -> None:
+    global _worker_romanizer, _worker_hashed
+    _worker_romanizer = Romanizer.from_file(key, prop_typical,
+                                            encoding=encoding)
+    _worker_options.update(samples=samples, interleave=interleave)
+    _worker_hashed = hashed
+
+def _run_shard(task: tuple) -> tuple[int, Optional[dict], int,
+                                     Optional[str]]:
+    index, in_file, out_files, align_files, start, end, seed = task
+    digest = new_hash() if _worker_hashed else None
+    romanize_shard(_worker_romanizer, in_file, out_files, start, end, seed,
+                   align_files=align_files, digest=digest, **_worker_options)
+    # stats of pool workers are sent back to the parent
+    return(index, STATS.collect(), start,
+           digest.hexdigest() if digest is not None else None)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--key", 
@@ -221,32 +746,165 @@ if __name__ == "__main__":
                             Romanization options for each char")
     parser.add_argument("--encoding", type=str, default='utf8',
                         help="document encoding")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="global random seed; output is identical for\
+                            a given seed regardless of --workers")
+    parser.add_argument("--chunk_size", type=int, default=64 * 2**20,
+                        help="files larger than this many bytes are split\
+                            into shards that are romanized separately")
+    parser.add_argument("--samples", type=int, default=1,
+                        help="number of independent romanizations of each\
+                            line; written to out_dir/sample_k unless\
+                                --interleave is given")
+    parser.add_argument("--interleave", action="store_true",
+                        help="write all samples of a line on consecutive\
+                            lines of a single output tree")
+    parser.add_argument("--align_dir", type=str, default=None,
+                        help="also write the segment alignment of every\
+                            output file to the same path in this directory")
+    parser.add_argument("--compress", type=str, default=None,
+                        choices=[ext[1:] for ext in COMPRESSED] + ["none"],
+                        help="compression of the output files; by default\
+                            each output is compressed like its input")
+    parser.add_argument("--incremental", action="store_true",
+                        help="allow an existing output directory and only\
+                            romanize new or changed files")
+    add_arguments(parser)
     
     args = parser.parse_args()
     
-    # writing over existing files is not allowed        
-    if Path(args.out_dir).is_dir():
-        raise Exception(
-            f"Choose a different directory name or delete existing \
-                directory {args.out_dir}.")
-        
-    # build Romanization object
-    romanizer = Romanizer.from_file(args.key, args.prop_typical, 
-                                    encoding = args.encoding)
+    # writing over existing files is only allowed in incremental mode
+    for out_dir in [args.out_dir, args.align_dir]:
+        if out_dir is not None and Path(out_dir).is_dir() \
+            and not args.incremental:
+            raise Exception(
+                f"Choose a different directory name or delete existing \
+                    directory {out_dir}.")
+
+    # an incremental run keeps the seed of the previous run
+    previous = Manifest(args.out_dir, {}).stored_config \
+        if args.incremental else None
+    if args.seed is None and previous is not None:
+        args.seed = previous["seed"]
+    if args.seed is None:
+        args.seed = random.SystemRandom().randrange(2**32)
+        print(f"Using seed {args.seed}")
+
+    manifest = None
+    if args.incremental:
+        manifest = Manifest(args.out_dir, {
+            "script": "generate_romanization", "key": file_hash(args.key),
+            "prop_typical": args.prop_typical, "encoding": args.encoding,
+            "seed": args.seed, "chunk_size": args.chunk_size,
+            "samples": args.samples, "interleave": args.interleave,
+            "compress": args.compress, "align_dir": args.align_dir})
+
+    # with several non-interleaved samples, sample k gets its own tree
+    if args.samples > 1 and not args.interleave:
+        out_roots = [Path(args.out_dir, f"sample_{k}")
+                     for k in range(args.samples)]
+    else:
+        out_roots = [Path(args.out_dir)]
     
-    # iterate through files and create parallel substructure
-    re_in_dir = re.compile(r'{}(.*)'.format(args.in_dir))
-    for file in glob.iglob(args.in_dir + "/**", recursive=True):
-        new_file = args.out_dir + '/' + re_in_dir.search(file).group(1)
+    # iterate through files, create parallel substructure
+    # and collect one task per shard
+    in_root = Path(args.in_dir)
+    tasks = []
+    inputs = []
+    outputs = []
+    ranges = []
+    digests = []
+    parts = []
+    rel_paths = []
+    for file in sorted(glob.glob(args.in_dir + "/**", recursive=True)):
         orig_path = Path(file)
-        new_path = Path(new_file)
+        rel_path = orig_path.relative_to(in_root).as_posix()
+        new_files = [str(Path(root, rel_path)) for root in out_roots]
+        if args.compress is not None and orig_path.is_file():
+            ext = "" if args.compress == "none" else args.compress
+            new_files = [with_compression(f, ext) for f in new_files]
+        # alignments mirror the output tree in align_dir
+        if args.align_dir is not None:
+            new_files += [str(Path(args.align_dir,
+                                   Path(f).relative_to(args.out_dir)))
+                          for f in new_files]
         
         # create corresponding subdirectories
         if orig_path.is_dir():
-            new_path.mkdir()
+            for new_file in new_files:
+                Path(new_file).mkdir(parents=True, exist_ok=True)
             
         else:
-            # romanize file
-            romanizer.romanize_file(file, new_file)
-    
-    
\ No newline at end of file
+            rel_paths.append(rel_path)
+            if manifest is not None and manifest.is_current(rel_path, file):
+                continue
+            
+            # shards are written to hidden temporary files and moved into
+            # place once the whole file is done
+            shards = plan_shards(file, args.chunk_size)
+            inputs.append((rel_path, file))
+            outputs.append(new_files)
+            ranges.append(shards)
+            digests.append({})
+            parts.append([])
+            for i, (start, end) in enumerate(shards):
+                out_files = [temp_path(f, f".part{i:05d}") for f in new_files]
+                parts[-1].append(out_files)
+                tasks.append((len(outputs) - 1, file,
+                              out_files[:len(out_roots)],
+                              out_files[len(out_roots):] or None, start, end,
+                              shard_seed(args.seed, rel_path, i)))
+
+    if manifest is not None:
+        removed = manifest.remove_stale(rel_paths)
+        print(f"{len(outputs)} files to process, {len(removed)} removed")
+
+    # romanize shards, then join the shards of each file
+    remaining = [len(p) for p in parts]
+    initargs = (args.key, args.prop_typical, args.encoding, args.samples,
+                args.interleave, manifest is not None)
+
+    def finish(index: int, stats: Optional[dict], start: int,
+               digest: Optional[str]) -> None:
+        STATS.merge(stats)
+        digests[index][start] = digest
+        if remaining[index] == len(parts[index]):
+            STATS.stage("romanize").add(files=1)
+        remaining[index] -= 1
+        if remaining[index] > 0:
+            return
+        
+        for k, new_file in enumerate(outputs[index]):
+            if len(parts[index]) == 1:
+                os.replace(parts[index][0][k], new_file)
+                continue
+            with atomic_output(new_file) as tmp_file:
+                with open(tmp_file, 'wb') as out:
+                    for part in parts[index]:
+                        with open(part[k], 'rb') as f:
+                            shutil.copyfileobj(f, out, IO_BUFFER)
+            for part in parts[index]:
+                os.remove(part[k])
+                
+        if manifest is not None:
+            # shard hashes combine to the file_hash of the shard ranges
+            manifest.record(*inputs[index], outputs[index],
+                            combine_hashes([digests[index][start] for
+                                            start, _ in ranges[index]]),
+                            ranges[index])
+
+    with session(args):
+        try:
+            if args.workers > 1:
+                with Pool(args.workers, _init_worker, initargs) as pool:
+                    for result in pool.imap_unordered(_run_shard, tasks):
+                        finish(*result)
+            else:
+                _init_worker(*initargs)
+                for task in tasks:
+                    finish(*_run_shard(task))
+        finally:
+            if manifest is not None:
+                manifest.save()
@@ -0,0 +1,220 @@
+"""
+    Module for incremental processing of directory trees.
+
+    A Manifest is kept in the output directory and records, for each
+    input file, its size, modification time and content hash, a hash of
+    the configuration it was processed with and the output files it
+    produced. Reruns skip inputs whose outputs are current, redo changed
+    or new inputs and remove the outputs of deleted inputs.
+
+    Outputs are written to hidden temporary files and renamed into place,
+    so an interrupted run never leaves half-written files behind.
+"""
+
+import hashlib, json, os, time
+
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterable, Optional
+
+from fileio import compression
+
+# constants
+MANIFEST = ".manifest.json"
+# buffer size for hashing files
+HASH_BUFFER = 2**20
+# minimum number of seconds between two saves of the manifest
+SAVE_INTERVAL = 5.0
+
+
+def new_hash():
+    """
+    Returns an empty hash object of the kind used for file contents, for
+    hashing a file while it is read
+
+    """
+    return(hashlib.blake2b(digest_size=16))
+
+
+def file_hash(file: str,
+              ranges: Optional[list[tuple[int, int]]] = None) -> str:
+    """
+    Returns the blake2b hash of a file's contents as a hex string. Given
+    several byte ranges that cover the file in order, returns the hash of
+    their hashes instead (see combine_hashes), so the ranges can be hashed
+    by different processes.
+
+    """
+    if ranges is not None and len(ranges) > 1:
+        return(combine_hashes([_range_hash(file, start, end)
+                               for start, end in ranges]))
+    return(_range_hash(file, 0, os.path.getsize(file)))
+
+
+def _range_hash(file: str, start: int, end: int) -> str:
+    digest = new_hash()
+    with open(file, 'rb') as f:
+        f.seek(start)
+        while f.tell() < end:
+            block = f.read(min(HASH_BUFFER, end - f.tell()))
+            if not block:
+                break
+            digest.update(block)
+    return(digest.hexdigest())
+
+
+def combine_hashes(digests: list[str]) -> str:
+    """
+    Returns the hash of a file from the hashes of its byte ranges, in
+    order; a single range's hash is returned as it is
+
+    """
+    if len(digests) == 1:
+        return(digests[0])
+    digest = new_hash()
+    for d in digests:
+        digest.update(bytes.fromhex(d))
+    return(digest.hexdigest())
+
+
+def config_hash(config: dict) -> str:
+    """
+    Returns a hash of a JSON-serializable configuration
+
+    """
+    data = json.dumps(config, sort_keys=True).encode('utf8')
+    return(hashlib.blake2b(data, digest_size=16).hexdigest())
+
+
+def temp_path(file: str, tag: str = "") -> str:
+    """
+    Hidden temporary name next to file, with tag added to the name;
+    hidden files are skipped when the next script globs the directory.
+    A compression extension is kept at the end, so the temporary file is
+    compressed in the same way.
+
+    """
+    path = Path(file)
+    ext = compression(file)
+    name = path.name[:len(path.name) - len(ext)]
+    return(str(path.with_name(f".{name}{tag}.tmp{ext}")))
+
+
+@contextmanager
+def atomic_output(file: str):
+    """
+    Yields a temporary path to write to, which replaces file only if the
+    block finishes without an exception
+
+    """
+    tmp = temp_path(file)
+    try:
+        yield tmp
+        os.replace(tmp, file)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+class Manifest:
+    def __init__(self, out_dir: str, config: dict) -> None:
+        """
+        Loads the manifest of out_dir, if any. Entries made with a
+        different config are treated as outdated.
+
+        Parameters
+        ----------
+        out_dir : str
+            output directory; the manifest is stored in out_dir/MANIFEST
+        config : dict
+            everything that affects the output (options, seed, hash of
+            the romanization key, ...)
+
+        """
+        self.out_dir = out_dir
+        self.file = Path(out_dir, MANIFEST)
+        self.config = config
+        self.config_hash = config_hash(config)
+        self.entries = {}
+        # config of the run that saved the manifest
+        self.stored_config = None
+        if self.file.is_file():
+            with open(self.file, encoding="utf8") as f:
+                data = json.load(f)
+            self.entries = data["files"]
+            self.stored_config = data["config"]
+        self._saved = time.monotonic()
+
+    def is_current(self, rel_path: str, in_file: str) -> bool:
+        """
+        Whether the outputs recorded for in_file exist and were made from
+        its current contents with the current config. The content hash is
+        only computed if the size or modification time changed.
+
+        """
+        entry = self.entries.get(rel_path)
+        if entry is None or entry["config"] != self.config_hash \
+            or not all(os.path.exists(f) for f in self._outputs(entry)):
+            return(False)
+
+        stat = os.stat(in_file)
+        if entry["size"] != stat.st_size:
+            return(False)
+        if entry["mtime_ns"] != stat.st_mtime_ns:
+            if entry["hash"] != file_hash(in_file, entry.get("ranges")):
+                return(False)
+            # contents unchanged; remember the new time
+            entry["mtime_ns"] = stat.st_mtime_ns
+        return(True)
+
+    def record(self, rel_path: str, in_file: str, outputs: list[str],
+               digest: Optional[str] = None,
+               ranges: Optional[list[tuple[int, int]]] = None) -> None:
+        """
+        Records that in_file was processed into outputs. digest is the
+        file_hash of in_file, with the given ranges; it is computed if not
+        given, which reads the file again. The manifest is saved at most
+        every SAVE_INTERVAL seconds; call save() at the end.
+
+        """
+        stat = os.stat(in_file)
+        entry = {
+            "size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+            "hash": digest if digest is not None
+                else file_hash(in_file, ranges),
+            "config": self.config_hash,
+            "outputs": [os.path.relpath(f, self.out_dir) for f in outputs]}
+        if ranges is not None and len(ranges) > 1:
+            entry["ranges"] = [list(r) for r in ranges]
+        self.entries[rel_path] = entry
+
+        if time.monotonic() - self._saved > SAVE_INTERVAL:
+            self.save()
+
+    def remove_stale(self, rel_paths: Iterable[str]) -> list[str]:
+        """
+        Deletes the outputs of inputs that are no longer in rel_paths and
+        drops their entries. Returns the removed input paths.
+
+        """
+        keep = set(rel_paths)
+        removed = [p for p in self.entries if p not in keep]
+        for rel_path in removed:
+            for file in self._outputs(self.entries.pop(rel_path)):
+                if os.path.exists(file):
+                    os.remove(file)
+        if removed:
+            self.save()
+        return(removed)
+
+    def _outputs(self, entry: dict) -> list[str]:
+        # outputs are stored relative to out_dir
+        return([os.path.join(self.out_dir, f) for f in entry["outputs"]])
+
+    def save(self) -> None:
+        self.file.parent.mkdir(parents=True, exist_ok=True)
+        with atomic_output(str(self.file)) as tmp:
+            with open(tmp, "w", encoding="utf8") as f:
+                json.dump({"config": self.config, "files": self.entries}, f,
+                          ensure_ascii=False, indent=1)
+        self._saved = time.monotonic()
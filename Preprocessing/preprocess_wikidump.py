@@ -8,11 +8,154 @@
     with the same names for each corresponding subdirectory and file.
 """
 
-import glob, re, argparse
+import glob, os, re, argparse
+from functools import partial
+from multiprocessing import Pool
 from pathlib import Path
+from typing import Optional
+
+from instrumentation import STATS, add_arguments, session
+from manifest import Manifest, atomic_output, new_hash
+from fileio import COMPRESSED, open_text, with_compression
 
 # constants
 SEP = "___SEP-MARKER___"
+# number of characters read at a time
+CHUNK_SIZE = 2**22
+# maximum length of a tag, including the brackets; a longer span between
+# '<' and '>' is kept as text
+MAX_TAG = 2**12
+
+# regex patterns
+re_tags = re.compile(r"<[^<>]{0,%d}>" % (MAX_TAG - 2))
+re_newline = re.compile(r"\n+")
+
+class WikidumpCleaner:
+    
+    def __init__(self, seps: str = "."):
+        """
+        Streaming version of the wikidump cleaning steps: removes all
+        'doc id' tags, starts a new line after every run of separators
+        (and any whitespace following it), collapses blank lines and
+        strips leading whitespace from the document.
+
+        Text is fed in chunks of any size. Tags (of up to MAX_TAG
+        characters) and separator runs that straddle two chunks are held
+        back until they are complete, so the output is the same as
+        processing the whole document at once.
+
+        Parameters
+        ----------
+        seps : str, optional
+            string concatenation of all acceptable line separators.
+            default is "."
+
+        """
+        self.re_esc_seps = re.compile("([" + re.escape(seps) + r"]+\s*)")
+        self.seps = set(seps)
+        self.reset()
+        
+    def reset(self) -> None:
+        """
+        Prepares the cleaner for a new document.
+
+        """
+        # raw text starting at a '<' that may begin an unfinished tag
+        self.pending_raw = ""
+        # tag-free text ending in separators or whitespace
+        self.pending_clean = ""
+        self.started = False
+        
+    def feed(self, text: str, final: bool = False) -> str:
+        """
+        Cleans the next chunk of a document. Returns the text that is
+        ready to be written; pass final=True with the last chunk.
+
+        """
+        raw = self.pending_raw + text
+        self.pending_raw = ""
+        
+        # hold back a '<' that has no closing '>' yet, while it can still
+        # start a tag
+        if not final:
+            start = raw.rfind('<')
+            if start != -1 and raw.find('>', start) == -1 \
+                and len(raw) - start < MAX_TAG:
+                self.pending_raw = raw[start:]
+                raw = raw[:start]
+        
+        clean = self.pending_clean + re_tags.sub("", raw)
+        self.pending_clean = ""
+        
+        # hold back trailing separators and whitespace, which may continue
+        # in the next chunk
+        if not final:
+            end = len(clean)
+            while end > 0 and (clean[end - 1] in self.seps
+                               or clean[end - 1].isspace()):
+                end -= 1
+            self.pending_clean = clean[end:]
+            clean = clean[:end]
+            
+        # mark all separators with newlines, one chunk per line
+        clean = self.re_esc_seps.sub("\\1\n", clean)
+        clean = re_newline.sub("\n", clean)
+        
+        if not self.started:
+            clean = clean.lstrip()
+            self.started = len(clean) > 0
+            
+        return(clean)
+    
+    def flush(self) -> str:
+        """
+        Returns any text still held back at the end of a document.
+
+        """
+        return(self.feed("", final=True))
+    
+    
+def preprocess_file(in_file: str, out_file: str, seps: str = ".",
+                    encoding: str = 'utf8', chunk_size: int = CHUNK_SIZE,
+                    digest=None) -> None:
+    """
+    Cleans one extracted wikidump file, reading and writing it in
+    chunks of chunk_size characters. Either file may be compressed (see
+    fileio.open_text). out_file only appears once it is complete. If a
+    hash object is given as digest, it is updated with the bytes of
+    in_file.
+
+    """
+    cleaner = WikidumpCleaner(seps)
+    stage = STATS.stage("wikidump")
+    chars = lines = 0
+    
+    with stage.time(), atomic_output(out_file) as tmp_file, \
+        open_text(in_file, encoding=encoding, digest=digest) as f_in, \
+        open_text(tmp_file, mode='w', encoding=encoding) as f_out:
+        for chunk in iter(lambda: f_in.read(chunk_size), ""):
+            clean = cleaner.feed(chunk)
+            f_out.write(clean)
+            chars += len(chunk)
+            lines += clean.count("\n")
+        clean = cleaner.flush()
+        f_out.write(clean)
+        lines += clean.count("\n")
+        
+    stage.add(files=1, bytes=os.path.getsize(in_file), chars=chars,
+              lines=lines)
+        
+        
+def _preprocess_task(task: tuple[str, str, str], hashed: bool = False,
+                     **kwargs):
+    rel_path, in_file, out_file = task
+    # the input is hashed while it is read, for the manifest
+    digest = new_hash() if hashed else None
+    preprocess_file(in_file, out_file, digest=digest, **kwargs)
+    # stats of pool workers are sent back to the parent
+    return(rel_path, STATS.collect(),
+           digest.hexdigest() if hashed else None)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -26,45 +169,75 @@ if __name__ == "__main__":
                                 and commas, use --seps ".,".')
     parser.add_argument("--encoding", type=str, default='utf8',
                         help="document encoding")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of files processed in parallel")
+    parser.add_argument("--chunk_size", type=int, default=CHUNK_SIZE,
+                        help="number of characters read at a time")
+    parser.add_argument("--compress", type=str, default=None,
+                        choices=[ext[1:] for ext in COMPRESSED] + ["none"],
+                        help="compression of the output files; by default\
+                            each output is compressed like its input")
+    parser.add_argument("--incremental", action="store_true",
+                        help="allow an existing output directory and only\
+                            process new or changed files")
+    add_arguments(parser)
                             
     args = parser.parse_args()
     
-    # writing over existing files is not allowed        
-    if Path(args.out_dir).is_dir():
+    # writing over existing files is only allowed in incremental mode
+    if Path(args.out_dir).is_dir() and not args.incremental:
         raise Exception(
             f"Choose a different directory name or delete existing directory {args.out_dir}.")
     
-    # regex patterns
-    re_in_dir = re.compile(r'{}(.*)'.format(args.in_dir))
-    re_tags = re.compile(r"<[^<>]*>")
-    re_newline = re.compile(r"\n+")
-    re_esc_seps = re.compile("([" + re.escape(args.seps) + "]+\s*)")
-    re_sep_marker = re.compile(SEP)
-    
-    for file in glob.iglob(args.in_dir + "/**", recursive=True):
-        new_file = args.out_dir + '/' + re_in_dir.search(file).group(1)
+    # create corresponding subdirectories, collect files
+    in_root = Path(args.in_dir)
+    tasks = []
+    for file in sorted(glob.glob(args.in_dir + "/**", recursive=True)):
         orig_path = Path(file)
-        new_path = Path(new_file)
+        rel_path = orig_path.relative_to(in_root)
+        new_path = Path(args.out_dir, rel_path)
+        if args.compress is not None and orig_path.is_file():
+            ext = "" if args.compress == "none" else args.compress
+            new_path = Path(with_compression(str(new_path), ext))
         
-        # create corresponding subdirectories
         if orig_path.is_dir():
-            new_path.mkdir()
+            new_path.mkdir(parents=True, exist_ok=True)
             
         else:
-            # read in text
-            full_contents = orig_path.read_text(encoding=args.encoding)
-            
-            # remove all 'doc id' tags
-            full_contents = re_tags.sub("", full_contents)
+            tasks.append((rel_path.as_posix(), file, str(new_path)))
             
-            # mark all separators, add newlines
-            full_contents = re_esc_seps.sub(r"\1" + SEP, full_contents)
-            full_contents = re_sep_marker.sub(r"\n", full_contents)
-            
-            # one chunk per line
-            full_contents = re_newline.sub("\n", full_contents)
-            full_contents = full_contents.lstrip()
+    # skip files whose output is current, remove outputs of deleted files
+    manifest = None
+    if args.incremental:
+        manifest = Manifest(args.out_dir, {"script": "preprocess_wikidump",
+                                           "seps": args.seps,
+                                           "encoding": args.encoding,
+                                           "compress": args.compress})
+        removed = manifest.remove_stale(task[0] for task in tasks)
+        tasks = [t for t in tasks if not manifest.is_current(*t[:2])]
+        print(f"{len(tasks)} files to process, {len(removed)} removed")
+        
+    by_path = {task[0]: task for task in tasks}
+    
+    def finish(rel_path: str, stats, digest: Optional[str]) -> None:
+        STATS.merge(stats)
+        if manifest is not None:
+            _, file, out_file = by_path[rel_path]
+            manifest.record(rel_path, file, [out_file], digest)
             
-            # write new file
-            new_path.write_text(full_contents, encoding=args.encoding)
-            
\ No newline at end of file
+    process = partial(_preprocess_task, seps=args.seps,
+                      encoding=args.encoding, chunk_size=args.chunk_size,
+                      hashed=manifest is not None)
+    
+    with session(args):
+        try:
+            if args.workers > 1:
+                with Pool(args.workers) as pool:
+                    for result in pool.imap_unordered(process, tasks):
+                        finish(*result)
+            else:
+                for task in tasks:
+                    finish(*process(task))
+        finally:
+            if manifest is not None:
+                manifest.save()
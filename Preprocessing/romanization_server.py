@@ -0,0 +1,471 @@
+"""
+    Script for a long-running romanization service, so that training
+    jobs and annotation tools can share compiled Romanizers instead of
+    each loading its own.
+
+    The server listens on a Unix socket (--socket) or on a TCP port on
+    localhost (--port) and speaks JSON lines. Every request is one JSON
+    object on one line:
+
+        {"id": 1, "key": "hye", "lines": ["...", "..."], "seed": 5}
+            -> {"id": 1, "lines": ["...", "..."]}
+        {"id": 2, "op": "metrics"}
+            -> {"id": 2, "metrics": {...}}
+        {"op": "stream", "key": "hye", "seed": 5}
+            switches the connection to streaming: every following line
+            of text is answered by its romanization, in order
+
+    "key" is the path or file name of one of the --key files and may be
+    left out if only one key is served; "seed" and "align" (see
+    Romanizer.romanize_batch) are optional. A request with a seed gets
+    the same output as romanize_batch with that seed, however it is
+    batched. Responses to one connection's requests may arrive out of
+    order; use "id" to match them.
+
+    Concurrent requests for the same key are grouped into micro-batches
+    of up to --batch_lines lines. Key files are checked every
+    --reload_interval seconds and reloaded when they change.
+"""
+
+import argparse, asyncio, json, os, socket, sys, time
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Optional
+
+from instrumentation import StageStats
+from generate_romanization import Romanizer
+
+# constants
+# maximum number of lines romanized in one micro-batch
+BATCH_LINES = 4096
+# seconds a batch waits for more requests once the queue is empty
+MAX_DELAY = 0.002
+# maximum size of one request line in bytes
+LINE_LIMIT = 2**24
+# number of requests (or streamed lines) in flight per connection
+CONNECTION_LIMIT = 256
+
+
+class KeyBatcher:
+    def __init__(self, key_file: str, prop_typical: float = 0.9,
+                 encoding: str = 'utf8', batch_lines: int = BATCH_LINES,
+                 max_delay: float = MAX_DELAY) -> None:
+        """
+        Holds the compiled Romanizer of one key file and romanizes the
+        requests queued for it in micro-batches. Call start() inside the
+        event loop.
+
+        """
+        self.key_file = key_file
+        self.prop_typical = prop_typical
+        self.encoding = encoding
+        self.batch_lines = batch_lines
+        self.max_delay = max_delay
+        self.romanizer = None
+        self.mtime_ns = None
+        self.rng = np.random.default_rng()
+        self.queue = asyncio.Queue()
+        # counters and latency (per request) and compute time (per batch)
+        self.requests = StageStats("requests")
+        self.batches = StageStats("batches")
+        self.reloads = 0
+        self.reload_error = None
+        # romanization holds the GIL, so one thread keeps the loop free
+        # for I/O without competing with itself
+        self._executor = ThreadPoolExecutor(1)
+
+    def _load(self) -> tuple[Romanizer, int]:
+        mtime_ns = os.stat(self.key_file).st_mtime_ns
+        romanizer = Romanizer.from_file(self.key_file, self.prop_typical,
+                                        encoding=self.encoding)
+        return(romanizer, mtime_ns)
+
+    async def start(self) -> None:
+        loop = asyncio.get_running_loop()
+        self.romanizer, self.mtime_ns = await loop.run_in_executor(
+            None, self._load)
+        self._task = asyncio.create_task(self._run())
+
+    async def reload_if_changed(self) -> bool:
+        """
+        Reloads the key if its modification time changed. A key that
+        fails to load (e.g. while it is being written) is retried on the
+        next call; the previous Romanizer stays in use.
+
+        """
+        try:
+            if os.stat(self.key_file).st_mtime_ns == self.mtime_ns:
+                return(False)
+            loop = asyncio.get_running_loop()
+            self.romanizer, self.mtime_ns = await loop.run_in_executor(
+                None, self._load)
+        except Exception as e:
+            self.reload_error = f"{type(e).__name__}: {e}"
+            return(False)
+        self.reloads += 1
+        self.reload_error = None
+        return(True)
+
+    async def submit(self, lines: list[str],
+                     rng: Optional[np.random.Generator] = None,
+                     align: bool = False) -> tuple[list[str], Optional[list]]:
+        """
+        Queues lines for romanization and returns (romanized lines,
+        alignments or None). Lines without their own generator draw from
+        the server's.
+
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((lines, rng if rng is not None else self.rng,
+                              align, future,
+                              time.perf_counter()))
+        return(await future)
+
+    async def _next_batch(self) -> list[tuple]:
+        batch = [await self.queue.get()]
+        size = len(batch[0][0])
+        deadline = time.perf_counter() + self.max_delay
+        while size < self.batch_lines:
+            if self.queue.empty():
+                # wait once for more requests, then take what has arrived
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                await asyncio.sleep(timeout)
+                continue
+            item = self.queue.get_nowait()
+            batch.append(item)
+            size += len(item[0])
+        return(batch)
+
+    def _romanize(self, romanizer: Romanizer, batch: list[tuple]) -> list:
+        lines = [line for item in batch for line in item[0]]
+        rngs = [item[1] for item in batch for _ in item[0]]
+        align = any(item[2] for item in batch)
+        with self.batches.time():
+            result = romanizer.romanize_batch(lines, rngs, align)
+        romanized, alignments = result if align else (result, None)
+
+        results = []
+        start = 0
+        for item in batch:
+            end = start + len(item[0])
+            results.append((romanized[start:end],
+                            [a[1:].tolist() for a in alignments[start:end]]
+                            if item[2] else None))
+            start = end
+        return(results)
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            try:
+                results = await loop.run_in_executor(
+                    self._executor, self._romanize, self.romanizer, batch)
+            except Exception as e:
+                for item in batch:
+                    if not item[3].done():
+                        item[3].set_exception(e)
+                continue
+
+            now = time.perf_counter()
+            lines = sum(len(item[0]) for item in batch)
+            self.batches.add(batches=1, lines=lines)
+            for item, result in zip(batch, results):
+                self.requests.timings.add(now - item[4])
+                if not item[3].done():
+                    item[3].set_result(result)
+            self.requests.add(requests=len(batch), lines=lines,
+                              chars=sum(len(line) for item in batch
+                                        for line in item[0]))
+
+    def metrics(self, elapsed: float) -> dict:
+        lines = self.requests.counters["lines"]
+        batches = self.batches.counters["batches"]
+        return({"requests": self.requests.to_dict(),
+                "batches": self.batches.to_dict(),
+                "lines_per_s": lines / max(elapsed, 1e-9),
+                "mean_batch_lines": lines / batches if batches else 0.0,
+                "queued": self.queue.qsize(),
+                "reloads": self.reloads,
+                "reload_error": self.reload_error})
+
+    async def close(self) -> None:
+        self._task.cancel()
+        self._executor.shutdown(wait=False)
+
+
+class RomanizationServer:
+    def __init__(self, key_files: list[str], prop_typical: float = 0.9,
+                 encoding: str = 'utf8', batch_lines: int = BATCH_LINES,
+                 max_delay: float = MAX_DELAY,
+                 reload_interval: float = 2.0) -> None:
+        """
+        Serves the given key files; see the module docstring for the
+        protocol. Keys are addressed by their path as given or their file
+        name, with or without extension.
+
+        """
+        self.batchers = {}
+        self.names = {}
+        for key_file in key_files:
+            batcher = KeyBatcher(key_file, prop_typical, encoding,
+                                 batch_lines, max_delay)
+            self.batchers[key_file] = batcher
+            path = Path(key_file)
+            for name in (key_file, path.name, path.stem):
+                self.names.setdefault(name, batcher)
+        self.encoding = encoding
+        self.reload_interval = reload_interval
+        self.started = time.time()
+        self.connections = 0
+
+    def batcher(self, key: Optional[str]) -> KeyBatcher:
+        if key is None and len(self.batchers) == 1:
+            return(next(iter(self.batchers.values())))
+        if key not in self.names:
+            raise KeyError(f"Unknown key {key}; expected one of "
+                           f"{', '.join(self.batchers)}.")
+        return(self.names[key])
+
+    async def _watch(self) -> None:
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            for key_file, batcher in self.batchers.items():
+                if await batcher.reload_if_changed():
+                    print(f"Reloaded {key_file}", file=sys.stderr)
+
+    def metrics(self) -> dict:
+        elapsed = time.time() - self.started
+        return({"elapsed": elapsed, "connections": self.connections,
+                "keys": {key_file: batcher.metrics(elapsed) for
+                         key_file, batcher in self.batchers.items()}})
+
+    async def _respond(self, request: dict) -> dict:
+        response = {"id": request.get("id")}
+        try:
+            if request.get("op") == "metrics":
+                response["metrics"] = self.metrics()
+                return(response)
+            if request.get("op", "romanize") != "romanize":
+                raise ValueError(f"Unknown op {request['op']}.")
+
+            batcher = self.batcher(request.get("key"))
+            lines = request["lines"]
+            if not isinstance(lines, list) \
+                or not all(isinstance(line, str) for line in lines):
+                raise TypeError("Expected a list of strings as lines.")
+            seed = request.get("seed")
+            rng = np.random.default_rng(seed) if seed is not None else None
+            lines, alignments = await batcher.submit(
+                lines, rng, bool(request.get("align")))
+            response["lines"] = lines
+            if alignments is not None:
+                response["alignments"] = alignments
+        except Exception as e:
+            response["error"] = f"{type(e).__name__}: {e}"
+        return(response)
+
+    async def _stream(self, reader: asyncio.StreamReader,
+                      writer: asyncio.StreamWriter, request: dict) -> None:
+        """
+        Romanizes every following line of the connection; lines are
+        submitted as they arrive and written back in order.
+
+        """
+        batcher = self.batcher(request.get("key"))
+        seed = request.get("seed")
+        rng = np.random.default_rng(seed) if seed is not None else None
+        pending = asyncio.Queue(CONNECTION_LIMIT)
+
+        async def write_results() -> None:
+            while (task := await pending.get()) is not None:
+                (line,), _ = await task
+                writer.write((line + '\n').encode(self.encoding))
+                await writer.drain()
+
+        writing = asyncio.create_task(write_results())
+        try:
+            while data := await reader.readline():
+                line = data.decode(self.encoding).rstrip('\n')
+                await pending.put(asyncio.create_task(
+                    batcher.submit([line], rng)))
+            await pending.put(None)
+            await writing
+        finally:
+            writing.cancel()
+
+    async def handle(self, reader: asyncio.StreamReader,
+                     writer: asyncio.StreamWriter) -> None:
+        self.connections += 1
+        slots = asyncio.Semaphore(CONNECTION_LIMIT)
+        tasks = set()
+
+        async def answer(request: dict) -> None:
+            try:
+                response = await self._respond(request)
+                writer.write((json.dumps(response, ensure_ascii=False)
+                              + '\n').encode('utf8'))
+                await writer.drain()
+            finally:
+                slots.release()
+
+        try:
+            while data := await reader.readline():
+                try:
+                    request = json.loads(data)
+                    if not isinstance(request, dict):
+                        raise ValueError("Expected a JSON object.")
+                except ValueError as e:
+                    writer.write((json.dumps({"id": None, "error": str(e)})
+                                  + '\n').encode('utf8'))
+                    continue
+                if request.get("op") == "stream":
+                    await asyncio.gather(*tasks)
+                    await self._stream(reader, writer, request)
+                    break
+
+                await slots.acquire()
+                task = asyncio.create_task(answer(request))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            await asyncio.gather(*tasks)
+        except asyncio.CancelledError:
+            # the server is shutting down
+            pass
+        except Exception as e:
+            writer.write((json.dumps({"error": f"{type(e).__name__}: {e}"})
+                          + '\n').encode('utf8'))
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    async def serve(self, socket_path: Optional[str] = None,
+                    host: str = "127.0.0.1", port: int = 0,
+                    ready: Optional[asyncio.Event] = None) -> None:
+        """
+        Loads all keys, then serves on a Unix socket if socket_path is
+        given, else on host:port, until cancelled
+
+        """
+        for batcher in self.batchers.values():
+            await batcher.start()
+
+        if socket_path is not None:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            server = await asyncio.start_unix_server(
+                self.handle, socket_path, limit=LINE_LIMIT)
+            address = socket_path
+        else:
+            server = await asyncio.start_server(
+                self.handle, host, port, limit=LINE_LIMIT)
+            self.port = server.sockets[0].getsockname()[1]
+            address = f"{host}:{self.port}"
+        print(f"Serving {', '.join(self.batchers)} on {address}",
+              file=sys.stderr, flush=True)
+        if ready is not None:
+            ready.set()
+
+        watcher = asyncio.create_task(self._watch())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            watcher.cancel()
+            for batcher in self.batchers.values():
+                await batcher.close()
+            if socket_path is not None and os.path.exists(socket_path):
+                os.remove(socket_path)
+
+
+class RomanizationClient:
+    def __init__(self, socket_path: Optional[str] = None,
+                 host: str = "127.0.0.1", port: Optional[int] = None,
+                 key: Optional[str] = None) -> None:
+        """
+        Minimal blocking client for request/response use, e.g. inside
+        DataLoader workers
+
+        """
+        if socket_path is not None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(socket_path)
+        else:
+            self.sock = socket.create_connection((host, port))
+        self.file = self.sock.makefile('rwb')
+        self.key = key
+        self._id = 0
+
+    def request(self, **request: Any) -> dict:
+        self._id += 1
+        request["id"] = self._id
+        self.file.write((json.dumps(request, ensure_ascii=False)
+                         + '\n').encode('utf8'))
+        self.file.flush()
+        response = json.loads(self.file.readline())
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        return(response)
+
+    def romanize(self, lines: list[str], seed: Optional[int] = None,
+                 align: bool = False):
+        request = {"lines": lines, "align": align}
+        if self.key is not None:
+            request["key"] = self.key
+        if seed is not None:
+            request["seed"] = seed
+        response = self.request(**request)
+        if align:
+            return(response["lines"], [np.array([[0, 0]] + a, dtype=np.int64)
+                                       for a in response["alignments"]])
+        return(response["lines"])
+
+    def metrics(self) -> dict:
+        return(self.request(op="metrics")["metrics"])
+
+    def close(self) -> None:
+        self.file.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--key", type=str, action="append", required=True,
+                        help="Romanization key to serve; may be repeated")
+    parser.add_argument("--socket", type=str, default=None,
+                        help="path of a Unix socket to listen on")
+    parser.add_argument("--port", type=int, default=8765,
+                        help="TCP port on localhost, if no --socket is\
+                            given")
+    parser.add_argument("--prop_typical", type=float, default=0.9, help=
+                        "amount of probability assigned to most common\
+                            Romanization options for each char")
+    parser.add_argument("--encoding", type=str, default='utf8',
+                        help="key and stream encoding")
+    parser.add_argument("--batch_lines", type=int, default=BATCH_LINES,
+                        help="maximum number of lines per micro-batch")
+    parser.add_argument("--max_delay", type=float, default=MAX_DELAY,
+                        help="seconds a micro-batch waits for more\
+                            requests")
+    parser.add_argument("--reload_interval", type=float, default=2.0,
+                        help="seconds between checks for changed keys")
+
+    args = parser.parse_args()
+
+    server = RomanizationServer(args.key, args.prop_typical, args.encoding,
+                                args.batch_lines, args.max_delay,
+                                args.reload_interval)
+    try:
+        asyncio.run(server.serve(args.socket, port=args.port))
+    except KeyboardInterrupt:
+        pass
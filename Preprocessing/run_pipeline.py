@@ -0,0 +1,282 @@
+"""
+    Script that runs the whole data preparation in a single read of an
+    extracted wikidump: tag removal and sentence splitting (as in
+    preprocess_wikidump.py), romanization (as in generate_romanization.py),
+    rare-character filtering and hash-based train/dev/test assignment.
+
+    Only the final split files are written, and optionally the tokenized
+    dataset (see tokenize_data.py). Source files hold the romanized text
+    and target files the original orthography.
+
+    Unlike clean_and_split_data.py, which checks the source side of
+    existing pairs for rare characters and hashes the whole pair, this
+    script filters and hashes the original orthography, since the
+    romanization is sampled here; empty lines are dropped as well. The
+    same corpus therefore ends up in different splits with the two
+    scripts.
+
+    Stages are connected by bounded queues: a reader thread cleans and
+    splits documents, worker processes romanize, filter and assign
+    batches of sentences, and a writer thread writes them in input order.
+"""
+
+import argparse, glob, threading, traceback
+import multiprocessing as mp
+
+from collections import Counter
+from pathlib import Path
+from typing import Iterator, Optional
+
+from preprocess_wikidump import WikidumpCleaner, CHUNK_SIZE
+from generate_romanization import Romanizer, shard_seed
+from clean_and_split_data import SPLITS, SplitWriter, split_bounds, \
+    split_by_hash
+from vocab import CharFilter, Vocabulary
+from fileio import open_text
+
+# constants
+STOP = None
+
+
+def iter_sentence_batches(files: list[str], in_root: str,
+                          seps: str = ".", encoding: str = 'utf8',
+                          batch_lines: int = 10000,
+                          chunk_size: int = CHUNK_SIZE
+                          ) -> Iterator[tuple[str, int, list[str]]]:
+    """
+    Streams extracted wikidump files through WikidumpCleaner and yields
+    (relative path, batch index, sentences) with up to batch_lines
+    sentences per batch.
+
+    """
+    for file in files:
+        rel_path = Path(file).relative_to(in_root).as_posix()
+        cleaner = WikidumpCleaner(seps)
+        carry = ""
+        batch = []
+        index = 0
+
+        with open_text(file, encoding=encoding) as f:
+            chunks = iter(lambda: f.read(chunk_size), "")
+            for chunk in chunks:
+                lines = (carry + cleaner.feed(chunk)).split("\n")
+                carry = lines.pop()
+                batch.extend(lines)
+
+                while len(batch) >= batch_lines:
+                    yield rel_path, index, batch[:batch_lines]
+                    batch = batch[batch_lines:]
+                    index += 1
+
+        batch.extend((carry + cleaner.flush()).split("\n"))
+        if batch and batch[-1] == "":
+            batch.pop()
+        if batch:
+            yield rel_path, index, batch
+
+
+def count_sentence_chars(files: list[str], in_root: str, seps: str = ".",
+                         encoding: str = 'utf8') -> Counter:
+    """
+    Counts non-whitespace characters of the cleaned sentences; used to
+    find rare characters when no vocabulary is given.
+
+    """
+    counts = Counter()
+    for _, _, batch in iter_sentence_batches(files, in_root, seps, encoding):
+        for line in batch:
+            counts.update(line)
+
+    for char in [c for c in counts if c.isspace()]:
+        del counts[char]
+
+    return(counts)
+
+
+def _worker(tasks: mp.Queue, results: mp.Queue, key: str,
+            prop_typical: float, encoding: str, char_set: Optional[list],
+            bounds: list[float], seed: int) -> None:
+    """
+    Stage 2: romanizes, filters and assigns batches of sentences.
+
+    """
+    try:
+        romanizer = Romanizer.from_file(key, prop_typical, encoding=encoding)
+        char_filter = CharFilter(char_set) if char_set is not None \
+            else None
+
+        for task in iter(tasks.get, STOP):
+            seq, rel_path, index, lines = task
+
+            # discard empty lines and lines with rare characters
+            kept = [line for line in lines if line.strip()]
+            if char_filter is not None:
+                kept = char_filter.filter(kept)
+            romanized = romanizer.romanize_batch(
+                kept, shard_seed(seed, rel_path, index))
+
+            rows = [(split_by_hash(tgt, bounds, seed), src, tgt)
+                    for src, tgt in zip(romanized, kept)]
+            results.put((seq, rows, len(lines) - len(kept)))
+
+    except Exception:
+        results.put((None, traceback.format_exc(), 0))
+
+
+def run_pipeline(files: list[str], in_root: str, out_dir: str, key: str,
+                 seps: str = ".", prop_typical: float = 0.9,
+                 char_set: Optional[list] = None,
+                 ratios: list[float] = [0.8, 0.1, 0.1], seed: int = 0,
+                 workers: int = 1, queue_size: int = 16,
+                 batch_lines: int = 10000,
+                 encoding: str = 'utf8') -> dict[str, int]:
+    """
+    Runs all stages and writes src_{split} and tgt_{split} files to
+    out_dir. At most queue_size batches are in flight at once, so a slow
+    stage holds back the ones before it. Output does not depend on the
+    number of workers. Returns the number of pairs per split and of
+    dropped lines.
+
+    """
+    bounds = split_bounds(ratios)
+    tasks = mp.Queue(queue_size)
+    results = mp.Queue()
+    in_flight = threading.Semaphore(queue_size)
+    stats = {"dropped": 0}
+    errors = []
+
+    processes = [mp.Process(target=_worker, daemon=True,
+                            args=(tasks, results, key, prop_typical,
+                                  encoding, char_set, bounds, seed))
+                 for _ in range(max(1, workers))]
+    for p in processes:
+        p.start()
+
+    # stage 1: clean and split documents
+    def read() -> int:
+        seq = 0
+        batches = iter_sentence_batches(files, in_root, seps, encoding,
+                                        batch_lines)
+        for rel_path, index, lines in batches:
+            in_flight.acquire()
+            if errors:
+                return(seq)
+            tasks.put((seq, rel_path, index, lines))
+            seq += 1
+        for _ in processes:
+            tasks.put(STOP)
+        return(seq)
+
+    # stage 3: write batches in input order
+    def write(writer: SplitWriter) -> None:
+        pending = {}
+        next_seq = 0
+        try:
+            while next_seq != total.get("batches") and not errors:
+                seq, rows, dropped = results.get()
+                if seq is None:
+                    errors.append(RuntimeError(
+                        f"Pipeline worker failed:\n{rows}"))
+                    break
+                pending[seq] = rows
+                stats["dropped"] += dropped
+
+                while next_seq in pending:
+                    for split, src, tgt in pending.pop(next_seq):
+                        writer.write(split, (src, tgt))
+                    next_seq += 1
+                    in_flight.release()
+        except Exception as e:
+            errors.append(e)
+        finally:
+            # let a waiting reader see the error
+            if errors:
+                in_flight.release()
+
+    Path(out_dir).mkdir(parents=True, exist_ok=True)
+    total = {}
+    with SplitWriter(out_dir, encoding) as writer:
+        writer_thread = threading.Thread(target=write, args=(writer,))
+        writer_thread.start()
+        try:
+            total["batches"] = read()
+        except Exception as e:
+            errors.append(e)
+        # wake the writer in case the last batch was already written
+        results.put((-1, [], 0))
+        writer_thread.join()
+
+    for p in processes:
+        if errors:
+            p.terminate()
+        p.join()
+
+    if errors:
+        raise errors[0]
+
+    stats.update(zip(SPLITS, writer.counts))
+    return(stats)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--in_dir", help="extracted wikidump directory")
+    parser.add_argument("--out_dir", default="data", type=str,
+                        help="output directory for the split files")
+    parser.add_argument("--key", type=str,
+                        help="name of .txt file containing Romanization key")
+    parser.add_argument("--seps", type=str, default=".",
+                        help="string concatenation of all acceptable\
+                            line separators")
+    parser.add_argument("--prop_typical", type=float, default=0.9, help=
+                        "amount of probability assigned to most common\
+                            Romanization options for each char")
+    parser.add_argument("--min_freq", type=int, default=1,
+                        help="drop lines with characters seen fewer times;\
+                            needs one extra counting pass unless --vocab\
+                                is given")
+    parser.add_argument("--vocab", type=str, default=None,
+                        help="saved Vocabulary of allowed characters for\
+                            the original orthography")
+    parser.add_argument("--ratios", type=float, nargs=3,
+                        default=[0.8, 0.1, 0.1],
+                        help="train, dev and test proportions")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed for romanization and split assignment")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes")
+    parser.add_argument("--queue_size", type=int, default=16,
+                        help="maximum number of sentence batches in flight")
+    parser.add_argument("--batch_lines", type=int, default=10000,
+                        help="number of sentences per batch")
+    parser.add_argument("--tokenize", action="store_true",
+                        help="also write the tokenized dataset to\
+                            out_dir/tokenized")
+    parser.add_argument("--encoding", type=str, default='utf8',
+                        help="document encoding")
+
+    args = parser.parse_args()
+
+    files = sorted(f for f in glob.glob(args.in_dir + "/**", recursive=True)
+                   if Path(f).is_file())
+
+    char_set = None
+    if args.vocab is not None:
+        vocab = Vocabulary.load(args.vocab)
+        char_set = [t for t in vocab.index_to_token
+                    if len(t) == 1 and t not in vocab.specials]
+    elif args.min_freq > 1:
+        counts = count_sentence_chars(files, args.in_dir, args.seps,
+                                      args.encoding)
+        char_set = [c for c, n in counts.items() if n >= args.min_freq]
+
+    stats = run_pipeline(files, args.in_dir, args.out_dir, args.key,
+                         args.seps, args.prop_typical, char_set, args.ratios,
+                         args.seed, args.workers, args.queue_size,
+                         args.batch_lines, args.encoding)
+    print(", ".join(f"{k}: {v}" for k, v in stats.items()))
+
+    if args.tokenize:
+        from tokenize_data import tokenize_splits
+        tokenize_splits(args.out_dir, f"{args.out_dir}/tokenized",
+                        encoding=args.encoding)
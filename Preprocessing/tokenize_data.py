@@ -0,0 +1,56 @@
+"""
+    Script for converting the train/dev/test files written by
+    clean_and_split_data.py into the memory-mapped token format read by
+    MemmapRomanizationDataset.
+    
+    Vocabularies are built from the training split and saved next to
+    the tokenized splits.
+"""
+
+import argparse
+
+from pathlib import Path
+
+from vocab import Vocabulary
+from data import PAD, write_tokenized
+
+
+def tokenize_splits(in_dir: str, out_dir: str, min_freq: int = 1,
+                    splits: list[str] = ["train", "dev", "test"],
+                    encoding: str = 'utf8') -> None:
+    """
+    Builds vocabularies from the training split of in_dir and writes
+    every split that exists to out_dir in the tokenized format.
+
+    """
+    src_vocab = Vocabulary.from_files([f"{in_dir}/src_train"],
+                                      encoding, specials=[PAD],
+                                      min_freq=min_freq)
+    tgt_vocab = Vocabulary.from_files([f"{in_dir}/tgt_train"],
+                                      encoding, specials=[PAD],
+                                      min_freq=min_freq)
+    
+    for split in splits:
+        if Path(in_dir, f"src_{split}").is_file():
+            write_tokenized(out_dir, split, [f"{in_dir}/src_{split}"],
+                            [f"{in_dir}/tgt_{split}"], src_vocab, tgt_vocab,
+                            encoding)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("in_dir", help="directory containing src_train,\
+                        tgt_train, etc.")
+    parser.add_argument("out_dir", help="output directory")
+    parser.add_argument("--min_freq", type=int, default=1,
+                        help="minimum frequency for char vocab")
+    parser.add_argument("--splits", type=str, nargs="+",
+                        default=["train", "dev", "test"],
+                        help="splits to convert")
+    parser.add_argument("--encoding", type=str, default='utf8',
+                        help="document encoding")
+    
+    args = parser.parse_args()
+    
+    tokenize_splits(args.in_dir, args.out_dir, args.min_freq, args.splits,
+                    args.encoding)